@@ -742,17 +742,13 @@ class LSSViewTransformerBEVDepth(LSSViewTransformer):
             gt_depths: [B*N*h*w, d]
         """
         B, N, H, W = gt_depths.shape
+        # min pooling of the valid depths over each downsample x downsample
+        # patch, reduced in place of the original layout without a permute
         gt_depths = gt_depths.view(B * N, H // self.downsample,
                                    self.downsample, W // self.downsample,
-                                   self.downsample, 1)
-        gt_depths = gt_depths.permute(0, 1, 3, 5, 2, 4).contiguous()
-        gt_depths = gt_depths.view(-1, self.downsample * self.downsample)
-        gt_depths_tmp = torch.where(gt_depths == 0.0,
-                                    1e5 * torch.ones_like(gt_depths),
-                                    gt_depths)
-        gt_depths = torch.min(gt_depths_tmp, dim=-1).values
-        gt_depths = gt_depths.view(B * N, H // self.downsample,
-                                   W // self.downsample)
+                                   self.downsample)
+        gt_depths = gt_depths.masked_fill(gt_depths == 0.0, 1e5)
+        gt_depths = gt_depths.amin(dim=(2, 4))
 
         if not self.sid:
             gt_depths = (gt_depths - (self.grid_config['depth'][0] -
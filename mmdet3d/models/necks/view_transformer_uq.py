@@ -1,9 +1,13 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+import math
+import warnings
+from contextlib import nullcontext
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from mmcv.cnn import build_conv_layer
-from mmcv.runner import BaseModule, force_fp32
+from mmcv.runner import BaseModule
 from torch.cuda.amp.autocast_mode import autocast
 from torch.utils.checkpoint import checkpoint
 
@@ -12,6 +16,196 @@ from mmdet.models.backbones.resnet import BasicBlock
 from ..builder import NECKS
 
 
+@torch.jit.script
+def inverse_3x3(mat: torch.Tensor) -> torch.Tensor:
+    """Invert a batch of 3x3 matrices in closed form with the adjugate.
+
+    The elementwise ops are fused by the JIT, which is much cheaper than the
+    general batched inversion for 3x3 matrices. Falls back to
+    `torch.linalg.inv_ex` for (nearly) singular matrices.
+
+    Args:
+        mat (torch.Tensor): Matrices in shape (..., 3, 3).
+
+    Returns:
+        torch.Tensor: Inverse matrices in shape (..., 3, 3).
+    """
+    a, b, c = mat[..., 0, 0], mat[..., 0, 1], mat[..., 0, 2]
+    d, e, f = mat[..., 1, 0], mat[..., 1, 1], mat[..., 1, 2]
+    g, h, i = mat[..., 2, 0], mat[..., 2, 1], mat[..., 2, 2]
+    co00 = e * i - f * h
+    co01 = f * g - d * i
+    co02 = d * h - e * g
+    det = a * co00 + b * co01 + c * co02
+    if bool((det.abs() < 1e-9).any()):
+        return torch.linalg.inv_ex(mat)[0]
+    adj = torch.stack([
+        co00, c * h - b * i, b * f - c * e,
+        co01, a * i - c * g, c * d - a * f,
+        co02, b * g - a * h, a * e - b * d], dim=-1)
+    return adj.reshape(mat.shape) / det[..., None, None]
+
+
+@torch.jit.script
+def _gauss_depth_prob(depth_mean: torch.Tensor, logvar: torch.Tensor,
+                      depth_bins: torch.Tensor, num_bins: float,
+                      eps: float) -> torch.Tensor:
+    """Discretize a Gaussian depth distribution over the depth bins.
+
+    The pointwise chain is fused by the JIT and the normalization is done by
+    a single softmax along the bins. The normalizing constant
+    -0.5 * (log(2 * pi) + logvar) of the log density does not depend on the
+    bin, so it cancels in the softmax and is not computed.
+
+    Args:
+        depth_mean (torch.Tensor): Mean depth normalized to [0, 1] in shape
+            (B, H, W).
+        logvar (torch.Tensor): Log variance in shape (B, H, W).
+        depth_bins (torch.Tensor): Depth bins broadcastable to (B, D, H, W).
+        num_bins (float): Scale from the normalized mean to bin units.
+        eps (float): Term added to the variance for stability.
+
+    Returns:
+        torch.Tensor: Depth probability in shape (B, D, H, W).
+    """
+    # the scale to bin units is fused into the subtraction
+    logits = -0.5 * (depth_bins -
+                     depth_mean.unsqueeze(1) * num_bins).pow(2) / (
+                         logvar.unsqueeze(1).exp() + eps)
+    return logits.softmax(dim=1)
+
+
+@torch.jit.script
+def _uq_loss(depth: torch.Tensor, logvar: torch.Tensor, gt_depth: torch.Tensor,
+             scale: float, beta: float = 1.0) -> torch.Tensor:
+    """Smooth L1 depth loss attenuated by the predicted uncertainty.
+
+    The inputs may be in half precision. They are upcast inside the fused
+    kernel, so that only the half precision values are read from memory
+    while the loss, which reaches D * e^10 and overflows FP16, and the
+    reduction are computed in FP32.
+
+    Args:
+        depth (torch.Tensor): Predicted normalized depth of the foreground
+            pixels.
+        logvar (torch.Tensor): Predicted log variance of the same pixels.
+        gt_depth (torch.Tensor): Normalized ground truth depth of the same
+            pixels.
+        scale (float): Scale from the normalized depth to bin units.
+        beta (float): Threshold of the smooth L1 loss.
+
+    Returns:
+        torch.Tensor: Mean loss in FP32.
+    """
+    depth = depth.float() * scale
+    gt_depth = gt_depth.float() * scale
+    logvar = logvar.float().clamp_min(-10.0)
+    smooth_value = F.smooth_l1_loss(
+        depth, gt_depth, reduction='none', beta=beta)
+    return (smooth_value * torch.exp(-logvar) * 0.5 + logvar * 0.5).mean()
+
+
+@torch.jit.script
+def _downsample_gt(gt_depths: torch.Tensor, downsample: int, D: int,
+                   dmin: float, dstep: float, sid: bool,
+                   log_dmin: torch.Tensor,
+                   log_dratio: torch.Tensor) -> torch.Tensor:
+    """Downsample the ground truth depth and convert it to bin units.
+
+    Args:
+        gt_depths (torch.Tensor): Depth maps in shape (B, N, H, W), zero for
+            pixels without depth.
+        downsample (int): Down sample scale factor of the feature map.
+        D (int): Number of depth bins.
+        dmin (float): Lower bound of the depth grid.
+        dstep (float): Interval of the depth grid.
+        sid (bool): Whether the bins are spacing-increasing.
+        log_dmin (torch.Tensor): log(dmin), used if `sid`.
+        log_dratio (torch.Tensor): log((dmax - 1) / dmin), used if `sid`.
+
+    Returns:
+        torch.Tensor: Depth in bin units in shape (B*N, h, w), zero for
+            invalid pixels.
+    """
+    BN = gt_depths.shape[0] * gt_depths.shape[1]
+    H, W = gt_depths.shape[2], gt_depths.shape[3]
+    # min pooling of the valid depths over each downsample x downsample
+    # patch, reduced in place of the original layout without a permute
+    gt_depths = gt_depths.view(BN, H // downsample, downsample,
+                               W // downsample, downsample)
+    gt_depths = gt_depths.masked_fill(gt_depths == 0.0, 1e5)
+    gt_depths = gt_depths.amin(dim=[2, 4])
+    if sid:
+        gt_depths = (torch.log(gt_depths) - log_dmin) * (D - 1) / log_dratio
+        gt_depths = gt_depths + 1.
+    else:
+        gt_depths = (gt_depths - (dmin - dstep)) / dstep
+    return torch.where((gt_depths < D) & (gt_depths >= 0.0), gt_depths,
+                       torch.zeros_like(gt_depths))
+
+
+@torch.jit.script
+def _depth_onehot(gt_bins: torch.Tensor, D: int) -> torch.Tensor:
+    """One-hot depth labels of the bins.
+
+    Bin 0 marks invalid pixels, which get an all-zero row. The labels are
+    scattered into a (N, D) buffer directly, instead of slicing off the
+    first column of a (N, D + 1) one-hot tensor.
+
+    Args:
+        gt_bins (torch.Tensor): Depth in bin units.
+        D (int): Number of depth bins.
+
+    Returns:
+        torch.Tensor: One-hot labels in shape (N, D).
+    """
+    gt_bins = gt_bins.reshape(-1).long()
+    valid = (gt_bins >= 1).float().unsqueeze(1)
+    onehot = torch.zeros(gt_bins.shape[0], D, dtype=torch.float32,
+                         device=gt_bins.device)
+    return onehot.scatter_(1, (gt_bins - 1).clamp_min(0).unsqueeze(1), valid)
+
+
+def _capture_cuda_graph(fn, static_inputs, num_warmup=3):
+    """Capture `fn` on static inputs in a CUDA graph.
+
+    The replay of the captured graph is checked against an eager run on the
+    same inputs, as kernels launched outside of the capturing stream are
+    silently missing from the graph.
+
+    Args:
+        fn (callable): Function of the static inputs returning a tensor or a
+            tuple of tensors.
+        static_inputs (tuple(torch.Tensor)): Inputs the graph reads from.
+        num_warmup (int): Number of eager runs on a side stream before the
+            capture.
+
+    Returns:
+        tuple: The graph and its static outputs, or (None, None) if the
+            replay does not match the eager result.
+    """
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        for _ in range(num_warmup):
+            fn(*static_inputs)
+    torch.cuda.current_stream().wait_stream(stream)
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        static_outputs = fn(*static_inputs)
+    graph.replay()
+    expected = fn(*static_inputs)
+    if isinstance(static_outputs, torch.Tensor):
+        outputs, expected = (static_outputs, ), (expected, )
+    else:
+        outputs = static_outputs
+    for output, target in zip(outputs, expected):
+        if not torch.allclose(output.float(), target.float(), rtol=1e-4,
+                              atol=1e-5):
+            return None, None
+    return graph, static_outputs
+
+
 @NECKS.register_module()
 class LSSViewTransformerUQ(BaseModule):
     r"""Lift-Splat-Shoot view transformer with BEVPoolv2 implementation.
@@ -29,12 +223,28 @@ class LSSViewTransformerUQ(BaseModule):
         in_channels (int): Channels of input feature.
         out_channels (int): Channels of transformed feature.
         accelerate (bool): Whether the view transformation is conducted with
-            acceleration. Note: the intrinsic and extrinsic of cameras should
-            be constant when 'accelerate' is set true.
+            acceleration, i.e. the pooling ranks are cached per calibration
+            of the cameras. This is always the case at inference, but it
+            only saves time when the calibration is truly static, e.g. a
+            fixed rig with an identity ego pose. On nuScenes the camera to
+            key ego transform changes every sample and the cache never hits.
+        calib_cache_size (int): Number of calibrations whose pooling ranks
+            are cached. Multi-frame detectors alternate between the
+            calibrations of their frames, so with static calibration it
+            should be at least the number of frames.
         sid (bool): Whether to use Spacing Increasing Discretization (SID)
             depth distribution as `STS: Surround-view Temporal Stereo for
             Multi-view 3D Detection`.
         collapse_z (bool): Whether to collapse in z direction.
+        quantize_pool (bool): Whether to run the voxel pooling on INT8
+            depth and features at inference.
+        use_cuda_graph (bool): Whether to replay the view transformation
+            from a captured CUDA graph at inference. A graph is only captured
+            for a cached calibration once it has been hit, so like the cache
+            it only helps with static calibration.
+        fuse_depth_softmax (bool): Whether to fuse the depth softmax into the
+            pooling at inference. The depth logits are then returned instead
+            of the depth distribution.
     """
 
     def __init__(
@@ -47,21 +257,98 @@ class LSSViewTransformerUQ(BaseModule):
         accelerate=False,
         sid=False,
         collapse_z=True,
+        quantize_pool=False,
+        use_cuda_graph=False,
+        calib_cache_size=2,
+        fuse_depth_softmax=False,
     ):
         super(LSSViewTransformerUQ, self).__init__()
         self.grid_config = grid_config
         self.downsample = downsample
         self.create_grid_infos(**grid_config)
         self.sid = sid
-        self.frustum = self.create_frustum(grid_config['depth'],
-                                           input_size, downsample)
+        # the frustum is kept as its three 1-D axes and only broadcast to
+        # (D, H, W) when it is transformed in `frustum_to_cam`
+        frustum_axes = self.create_frustum_axes(grid_config['depth'],
+                                                input_size, downsample)
+        for name, axis in zip(('frustum_x', 'frustum_y', 'frustum_d'),
+                              frustum_axes):
+            self.register_buffer(name, axis, persistent=False)
         self.out_channels = out_channels
         self.in_channels = in_channels
         self.depth_net = nn.Conv2d(
             in_channels, self.D + self.out_channels, kernel_size=1, padding=0)
         self.accelerate = accelerate
-        self.initial_flag = True
+        self.calib_cache_size = calib_cache_size
+        # least recently used first list of (calibration, cache entry)
+        self._calib_cache = []
         self.collapse_z = collapse_z
+        self.quantize_pool = quantize_pool
+        self.use_cuda_graph = use_cuda_graph
+        self.fuse_depth_softmax = fuse_depth_softmax
+        self._calib_entry = None
+        # ranks are kept as non-persistent buffers so that they follow the
+        # module across devices without polluting the checkpoints
+        for name in ('ranks_bev', 'ranks_feat', 'ranks_depth',
+                     'interval_starts', 'interval_lengths'):
+            self.register_buffer(name, None, persistent=False)
+        self._pts_cam_cache_key = None
+        self._cached_pts_cam = None
+
+    def _get_calib_cache(self, calib):
+        """Get the cache entry of a calibration.
+
+        The calibration tensors are flattened into a single key, which is
+        compared with all cached keys at once, so that a lookup costs one
+        host sync. On a miss, an empty entry is added and the least recently
+        used one is evicted.
+
+        Args:
+            calib (tuple(torch.Tensor)): Calibration tensors.
+
+        Returns:
+            dict: Cache entry of the calibration.
+        """
+        key = torch.cat([t.detach().reshape(-1).float() for t in calib])
+        candidates = [
+            idx for idx, (cached, _) in enumerate(self._calib_cache)
+            if cached.shape == key.shape and cached.device == key.device
+        ]
+        if candidates:
+            cached = torch.stack(
+                [self._calib_cache[idx][0] for idx in candidates])
+            matches = (cached == key).all(dim=1).tolist()
+            for idx, match in zip(candidates, matches):
+                if match:
+                    item = self._calib_cache.pop(idx)
+                    self._calib_cache.append(item)
+                    return item[1]
+        entry = dict()
+        self._calib_cache.append((key, entry))
+        if len(self._calib_cache) > self.calib_cache_size:
+            self._calib_cache.pop(0)
+        return entry
+
+    @staticmethod
+    def _is_cached_calib(cache_key, calib):
+        """Check whether the calibration equals the one a cache was built
+        with.
+
+        Args:
+            cache_key (tuple(torch.Tensor) | None): Calibration tensors the
+                cache was built with.
+            calib (tuple(torch.Tensor)): Current calibration tensors.
+
+        Returns:
+            bool: Whether the cached result can be reused.
+        """
+        if cache_key is None:
+            return False
+        for cached, cur in zip(cache_key, calib):
+            if cached.shape != cur.shape or cached.device != cur.device \
+                    or not torch.equal(cached, cur.to(cached)):
+                return False
+        return True
 
     def create_grid_infos(self, x, y, z, **kwargs):
         """Generate the grid information including the lower bound, interval,
@@ -76,13 +363,26 @@ class LSSViewTransformerUQ(BaseModule):
                 (lower_bound, upper_bound, interval).
             **kwargs: Container for other potential parameters
         """
-        self.grid_lower_bound = torch.Tensor([cfg[0] for cfg in [x, y, z]])
-        self.grid_interval = torch.Tensor([cfg[2] for cfg in [x, y, z]])
-        self.grid_size = torch.Tensor([(cfg[1] - cfg[0]) / cfg[2]
-                                       for cfg in [x, y, z]])
-
-    def create_frustum(self, depth_cfg, input_size, downsample):
-        """Generate the frustum template for each image.
+        # buffers follow the module to its device, so that `.to(coor)` in
+        # the forward pass does not copy them from the host every time
+        self.register_buffer(
+            'grid_lower_bound',
+            torch.tensor([cfg[0] for cfg in [x, y, z]], dtype=torch.float32),
+            persistent=False)
+        self.register_buffer(
+            'grid_interval',
+            torch.tensor([cfg[2] for cfg in [x, y, z]], dtype=torch.float32),
+            persistent=False)
+        self.register_buffer(
+            'grid_size',
+            torch.tensor([(cfg[1] - cfg[0]) / cfg[2] for cfg in [x, y, z]],
+                         dtype=torch.float32),
+            persistent=False)
+        # python ints of the grid size for shapes, avoiding device syncs
+        self._grid_size_int = tuple(int(s) for s in self.grid_size)
+
+    def create_frustum_axes(self, depth_cfg, input_size, downsample):
+        """Generate the axes of the frustum template for each image.
 
         Args:
             depth_cfg (tuple(float)): Config of grid alone depth axis in format
@@ -91,22 +391,40 @@ class LSSViewTransformerUQ(BaseModule):
                 width).
             downsample (int): Down sample scale factor from the input size to
                 the feature size.
+
+        Returns:
+            tuple(torch.Tensor): Pixel coordinates along the width and height
+                and depth values, in shape (W, ), (H, ) and (D, ).
         """
         H_in, W_in = input_size
         H_feat, W_feat = H_in // downsample, W_in // downsample
-        d = torch.arange(*depth_cfg, dtype=torch.float)\
-            .view(-1, 1, 1).expand(-1, H_feat, W_feat)
+        d = torch.arange(*depth_cfg, dtype=torch.float)
         self.D = d.shape[0]
         if self.sid:
             d_sid = torch.arange(self.D).float()
             depth_cfg_t = torch.tensor(depth_cfg).float()
-            d_sid = torch.exp(torch.log(depth_cfg_t[0]) + d_sid / (self.D-1) *
-                              torch.log((depth_cfg_t[1]-1) / depth_cfg_t[0]))
-            d = d_sid.view(-1, 1, 1).expand(-1, H_feat, W_feat)
-        x = torch.linspace(0, W_in - 1, W_feat,  dtype=torch.float)\
-            .view(1, 1, W_feat).expand(self.D, H_feat, W_feat)
-        y = torch.linspace(0, H_in - 1, H_feat,  dtype=torch.float)\
-            .view(1, H_feat, 1).expand(self.D, H_feat, W_feat)
+            d = torch.exp(torch.log(depth_cfg_t[0]) + d_sid / (self.D-1) *
+                          torch.log((depth_cfg_t[1]-1) / depth_cfg_t[0]))
+        x = torch.linspace(0, W_in - 1, W_feat,  dtype=torch.float)
+        y = torch.linspace(0, H_in - 1, H_feat,  dtype=torch.float)
+        return x, y, d
+
+    def create_frustum(self, depth_cfg, input_size, downsample):
+        """Generate the frustum template for each image.
+
+        Args:
+            depth_cfg (tuple(float)): Config of grid alone depth axis in format
+                of (lower_bound, upper_bound, interval).
+            input_size (tuple(int)): Size of input images in format of (height,
+                width).
+            downsample (int): Down sample scale factor from the input size to
+                the feature size.
+        """
+        x, y, d = self.create_frustum_axes(depth_cfg, input_size, downsample)
+        D, H, W = d.shape[0], y.shape[0], x.shape[0]
+        x = x.view(1, 1, W).expand(D, H, W)
+        y = y.view(1, H, 1).expand(D, H, W)
+        d = d.view(D, 1, 1).expand(D, H, W)
 
         # D x H x W x 3
         return torch.stack((x, y, d), -1)
@@ -137,21 +455,61 @@ class LSSViewTransformerUQ(BaseModule):
 
         # post-transformation
         # B x N x D x H x W x 3
-        points = self.frustum.to(sensor2ego) - post_trans.view(B, N, 1, 1, 1, 3)
-        points = torch.inverse(post_rots).view(B, N, 1, 1, 1, 3, 3)\
-            .matmul(points.unsqueeze(-1))
-        # import ipdb;ipdb.set_trace()
+        if self.training:
+            points = self.frustum_to_cam(post_rots, post_trans)
+        else:
+            points = self._precompute_frustum_cam(post_rots, post_trans)
+
+        # cam_to_ego, with the bda rotation folded into the 3x3 transforms
+        # so that the frustum points are only transformed once
+        bda = bda.view(B, 1, 3, 3)
+        combine = bda.matmul(sensor2ego[:, :, :3, :3]).matmul(
+            inverse_3x3(cam2imgs))
+        trans = bda.matmul(sensor2ego[:, :, :3, 3:4]).view(B, N, 1, 1, 1, 3)
+        points = torch.einsum('bnij,bndhwj->bndhwi', combine, points) + trans
+        return points
 
-        # cam_to_ego
-        points = torch.cat(
-            (points[..., :2, :] * points[..., 2:3, :], points[..., 2:3, :]), 5)
-        combine = sensor2ego[:,:,:3,:3].matmul(torch.inverse(cam2imgs))
-        points = combine.view(B, N, 1, 1, 1, 3, 3).matmul(points).squeeze(-1)
-        points += sensor2ego[:,:,:3, 3].view(B, N, 1, 1, 1, 3)
-        points = bda.view(B, 1, 1, 1, 1, 3,
-                          3).matmul(points.unsqueeze(-1)).squeeze(-1)
+    def frustum_to_cam(self, post_rots, post_trans):
+        """Undo the image view augmentation of the frustum points and lift
+        them to the homogeneous camera coordinate scaled by depth.
+
+        Args:
+            post_rots (torch.Tensor): Rotation in camera coordinate system in
+                shape (B, N_cams, 3, 3).
+            post_trans (torch.Tensor): Translation in camera coordinate system
+                in shape (B, N_cams, 3).
+
+        Returns:
+            torch.tensor: Point coordinates in shape
+                (B, N_cams, D, H, W, 3)
+        """
+        B, N, _ = post_trans.shape
+        # inv(R) @ (p - t) = x * inv(R)[:, 0] + y * inv(R)[:, 1]
+        #                    + d * inv(R)[:, 2] - inv(R) @ t
+        # is broadcast from the 1-D frustum axes, so the (D, H, W, 3)
+        # frustum is never built
+        inv_post_rots = inverse_3x3(post_rots).view(
+            B, N, 1, 1, 1, 3, 3)
+        x = self.frustum_x.to(post_trans).view(1, 1, 1, 1, -1, 1)
+        y = self.frustum_y.to(post_trans).view(1, 1, 1, -1, 1, 1)
+        d = self.frustum_d.to(post_trans).view(1, 1, -1, 1, 1, 1)
+        offset = inv_post_rots.matmul(
+            post_trans.view(B, N, 1, 1, 1, 3, 1)).squeeze(-1)
+        points = (x * inv_post_rots[..., 0] + y * inv_post_rots[..., 1]) + \
+            (d * inv_post_rots[..., 2] - offset)
+        points[..., :2] *= points[..., 2:3]
         return points
 
+    @torch.no_grad()
+    def _precompute_frustum_cam(self, post_rots, post_trans):
+        """Cached `frustum_to_cam` for inference, where the image view
+        augmentation is fixed and only the extrinsics vary between scenes."""
+        calib = (post_rots, post_trans)
+        if not self._is_cached_calib(self._pts_cam_cache_key, calib):
+            self._cached_pts_cam = self.frustum_to_cam(post_rots, post_trans)
+            self._pts_cam_cache_key = tuple(t.clone() for t in calib)
+        return self._cached_pts_cam
+
     def init_acceleration_v2(self, coor):
         """Pre-compute the necessary information in acceleration including the
         index of points in the final feature.
@@ -166,6 +524,12 @@ class LSSViewTransformerUQ(BaseModule):
         ranks_bev, ranks_depth, ranks_feat, \
             interval_starts, interval_lengths = \
             self.voxel_pooling_prepare_v2(coor)
+        if ranks_bev is None:
+            # no point falls in the grid, `view_transform_core` falls back to
+            # `voxel_pooling_v2` which handles this case
+            self.ranks_bev = self.ranks_feat = self.ranks_depth = None
+            self.interval_starts = self.interval_lengths = None
+            return
 
         self.ranks_bev = ranks_bev.int().contiguous()
         self.ranks_feat = ranks_feat.int().contiguous()
@@ -173,7 +537,7 @@ class LSSViewTransformerUQ(BaseModule):
         self.interval_starts = interval_starts.int().contiguous()
         self.interval_lengths = interval_lengths.int().contiguous()
 
-    def voxel_pooling_v2(self, coor, depth, feat):
+    def voxel_pooling_v2(self, coor, depth, feat, fused_softmax=False):
         ranks_bev, ranks_depth, ranks_feat, \
             interval_starts, interval_lengths = \
             self.voxel_pooling_prepare_v2(coor)
@@ -182,24 +546,32 @@ class LSSViewTransformerUQ(BaseModule):
                   'bev receptive field')
             dummy = torch.zeros(size=[
                 feat.shape[0], feat.shape[2],
-                int(self.grid_size[2]),
-                int(self.grid_size[0]),
-                int(self.grid_size[1])
+                self._grid_size_int[2],
+                self._grid_size_int[0],
+                self._grid_size_int[1]
             ]).to(feat)
-            dummy = torch.cat(dummy.unbind(dim=2), 1)
+            dummy = dummy.flatten(1, 2)
             return dummy
         feat = feat.permute(0, 1, 3, 4, 2)
-        bev_feat_shape = (depth.shape[0], int(self.grid_size[2]),
-                          int(self.grid_size[1]), int(self.grid_size[0]),
+        bev_feat_shape = (depth.shape[0], self._grid_size_int[2],
+                          self._grid_size_int[1], self._grid_size_int[0],
                           feat.shape[-1])  # (B, Z, Y, X, C)
         bev_feat = bev_pool_v2(depth, feat, ranks_depth, ranks_feat, ranks_bev,
                                bev_feat_shape, interval_starts,
-                               interval_lengths)
-        # collapse Z
+                               interval_lengths, fused_softmax,
+                               self.quantize_pool and not self.training)
+        # collapse Z, (B, C, Z, Y, X) -> (B, Z*C, Y, X) in the same channel
+        # order as concatenating the Z slices. This is a view when Z == 1.
         if self.collapse_z:
-            bev_feat = torch.cat(bev_feat.unbind(dim=2), 1)
+            B, C, Z, Y, X = bev_feat.shape
+            bev_feat = bev_feat.transpose(1, 2).reshape(B, Z * C, Y, X)
         return bev_feat
 
+    @property
+    def use_cached_ranks(self):
+        """bool: Whether the pooling ranks are cached across forwards."""
+        return self.accelerate or not self.training
+
     def voxel_pooling_prepare_v2(self, coor):
         """Data preparation for voxel pooling.
 
@@ -216,84 +588,137 @@ class LSSViewTransformerUQ(BaseModule):
         B, N, D, H, W, _ = coor.shape
         num_points = B * N * D * H * W
         # record the index of selected points for acceleration purpose
-        ranks_depth = torch.range(
-            0, num_points - 1, dtype=torch.int, device=coor.device)
-        ranks_feat = torch.range(
-            0, num_points // D - 1, dtype=torch.int, device=coor.device)
+        ranks_depth = torch.arange(
+            num_points, dtype=torch.int32, device=coor.device)
+        ranks_feat = torch.arange(
+            num_points // D, dtype=torch.int32, device=coor.device)
         ranks_feat = ranks_feat.reshape(B, N, 1, H, W)
         ranks_feat = ranks_feat.expand(B, N, D, H, W).flatten()
         # convert coordinate into the voxel space
         coor = ((coor - self.grid_lower_bound.to(coor)) /
                 self.grid_interval.to(coor))
-        coor = coor.long().view(num_points, 3)
-        batch_idx = torch.range(0, B - 1).reshape(B, 1). \
-            expand(B, num_points // B).reshape(num_points, 1).to(coor)
-        coor = torch.cat((coor, batch_idx), 1)
+        coor = coor.to(torch.int32).view(num_points, 3)
+        grid_size = self.grid_size.to(coor)
 
         # filter out points that are outside box
-        kept = (coor[:, 0] >= 0) & (coor[:, 0] < self.grid_size[0]) & \
-               (coor[:, 1] >= 0) & (coor[:, 1] < self.grid_size[1]) & \
-               (coor[:, 2] >= 0) & (coor[:, 2] < self.grid_size[2])
+        kept = ((coor >= 0) & (coor < grid_size)).all(dim=1)
         if len(kept) == 0:
             return None, None, None, None, None
         coor, ranks_depth, ranks_feat = \
             coor[kept], ranks_depth[kept], ranks_feat[kept]
-        # get tensors from the same voxel next to each other
-        ranks_bev = coor[:, 3] * (
-            self.grid_size[2] * self.grid_size[1] * self.grid_size[0])
-        ranks_bev += coor[:, 2] * (self.grid_size[1] * self.grid_size[0])
-        ranks_bev += coor[:, 1] * self.grid_size[0] + coor[:, 0]
-        order = ranks_bev.argsort()
-        ranks_bev, ranks_depth, ranks_feat = \
-            ranks_bev[order], ranks_depth[order], ranks_feat[order]
-
-        kept = torch.ones(
-            ranks_bev.shape[0], device=ranks_bev.device, dtype=torch.bool)
-        kept[1:] = ranks_bev[1:] != ranks_bev[:-1]
-        interval_starts = torch.where(kept)[0].int()
-        if len(interval_starts) == 0:
+        # get tensors from the same voxel next to each other, the batch
+        # index is recovered from the point index
+        batch_idx = torch.div(
+            ranks_depth, num_points // B, rounding_mode='floor')
+        ranks_bev = (batch_idx * grid_size[2] + coor[:, 2]) * grid_size[1]
+        ranks_bev = (ranks_bev + coor[:, 1]) * grid_size[0] + coor[:, 0]
+        ranks_bev, order = ranks_bev.sort()
+        ranks_depth, ranks_feat = ranks_depth[order], ranks_feat[order]
+
+        # run-length encoding of the sorted ranks gives the intervals
+        interval_lengths = torch.unique_consecutive(
+            ranks_bev, return_counts=True)[1]
+        if len(interval_lengths) == 0:
             return None, None, None, None, None
-        interval_lengths = torch.zeros_like(interval_starts)
-        interval_lengths[:-1] = interval_starts[1:] - interval_starts[:-1]
-        interval_lengths[-1] = ranks_bev.shape[0] - interval_starts[-1]
+        interval_starts = interval_lengths.cumsum(0) - interval_lengths
         return ranks_bev.int().contiguous(), ranks_depth.int().contiguous(
         ), ranks_feat.int().contiguous(), interval_starts.int().contiguous(
         ), interval_lengths.int().contiguous()
 
     def pre_compute(self, input):
-        if self.initial_flag:
-            coor = self.get_lidar_coor(*input[1:7])
-            self.init_acceleration_v2(coor)
-            self.initial_flag = False
-
-    def view_transform_core(self, input, depth, tran_feat):
+        # the ranks only depend on the calibration, they are cached per
+        # calibration and only computed for calibrations not seen recently
+        calib = (input[1], ) + tuple(input[3:7])
+        entry = self._get_calib_cache(calib)
+        self._calib_entry = entry
+        if 'ranks' in entry:
+            entry['hits'] = entry.get('hits', 0) + 1
+            (self.ranks_bev, self.ranks_feat, self.ranks_depth,
+             self.interval_starts, self.interval_lengths) = entry['ranks']
+            return
+        coor = self.get_lidar_coor(*input[1:7])
+        self.init_acceleration_v2(coor)
+        entry['ranks'] = (self.ranks_bev, self.ranks_feat, self.ranks_depth,
+                          self.interval_starts, self.interval_lengths)
+
+    def view_transform_core(self, input, depth, tran_feat,
+                            fused_softmax=False):
         B, N, C, H, W = input[0].shape
         
         # Lift-Splat
-        if self.accelerate:
+        if self.use_cached_ranks and self.ranks_feat is not None:
             feat = tran_feat.view(B, N, self.out_channels, H, W)
             feat = feat.permute(0, 1, 3, 4, 2)
             depth = depth.view(B, N, self.D, H, W)
-            bev_feat_shape = (depth.shape[0], int(self.grid_size[2]),
-                              int(self.grid_size[1]), int(self.grid_size[0]),
+            bev_feat_shape = (depth.shape[0], self._grid_size_int[2],
+                              self._grid_size_int[1], self._grid_size_int[0],
                               feat.shape[-1])  # (B, Z, Y, X, C)
             bev_feat = bev_pool_v2(depth, feat, self.ranks_depth,
                                    self.ranks_feat, self.ranks_bev,
                                    bev_feat_shape, self.interval_starts,
-                                   self.interval_lengths)
-
-            bev_feat = bev_feat.squeeze(2)
+                                   self.interval_lengths, fused_softmax,
+                                   self.quantize_pool and not self.training)
+            # collapse Z the same way as `voxel_pooling_v2`
+            if self.collapse_z:
+                B, C, Z, Y, X = bev_feat.shape
+                bev_feat = bev_feat.transpose(1, 2).reshape(B, Z * C, Y, X)
         else:
             coor = self.get_lidar_coor(*input[1:7])
             bev_feat = self.voxel_pooling_v2(
                 coor, depth.view(B, N, self.D, H, W),
-                tran_feat.view(B, N, self.out_channels, H, W))
+                tran_feat.view(B, N, self.out_channels, H, W),
+                fused_softmax)
         return bev_feat, depth
 
-    def view_transform(self, input, depth, tran_feat):
-        if self.accelerate:
+    def graphed_view_transform_core(self, input, depth, tran_feat,
+                                    fused_softmax=False):
+        """`view_transform_core` replayed from a CUDA graph.
+
+        The graph is captured on static copies of `depth` and `tran_feat`.
+        It reads the pooling ranks of the current calibration, so it is kept
+        in the cache entry of the calibration, and re-captured when the
+        shapes change. A calibration seen only once runs eagerly, as the
+        capture costs several eager runs and would be wasted on
+        calibrations that change every sample. If the replay does not match
+        the eager result, the graph is disabled.
+        """
+        entry = self._calib_entry
+        key = (tuple(input[0].shape), tuple(depth.shape), depth.dtype,
+               tuple(tran_feat.shape), tran_feat.dtype, fused_softmax)
+        if entry.get('graph_key') != key:
+            if entry.get('hits', 0) < 1:
+                return self.view_transform_core(input, depth, tran_feat,
+                                                fused_softmax)
+            entry.pop('graph', None)
+            static_inputs = (depth.clone(), tran_feat.clone())
+            graph, static_output = _capture_cuda_graph(
+                lambda d, f: self.view_transform_core(
+                    input, d, f, fused_softmax)[0], static_inputs)
+            if graph is None:
+                warnings.warn('The CUDA graph of the view transformation '
+                              'does not match the eager result, it is '
+                              'disabled.')
+                self.use_cuda_graph = False
+                return self.view_transform_core(input, depth, tran_feat,
+                                                fused_softmax)
+            entry['graph'] = (graph, static_inputs, static_output)
+            entry['graph_key'] = key
+        graph, static_inputs, static_output = entry['graph']
+        static_inputs[0].copy_(depth)
+        static_inputs[1].copy_(tran_feat)
+        graph.replay()
+        # the static output is overwritten by the next replay
+        return static_output.clone(), depth
+
+    def view_transform(self, input, depth, tran_feat, fused_softmax=False):
+        if self.use_cached_ranks:
             self.pre_compute(input)
-        return self.view_transform_core(input, depth, tran_feat)
+        if self.use_cuda_graph and not self.training and depth.is_cuda \
+                and self.ranks_feat is not None:
+            return self.graphed_view_transform_core(input, depth, tran_feat,
+                                                    fused_softmax)
+        return self.view_transform_core(input, depth, tran_feat,
+                                        fused_softmax)
 
     def forward(self, input):
         """Transform image-view feature into bird-eye-view feature.
@@ -303,7 +728,11 @@ class LSSViewTransformerUQ(BaseModule):
                 intrins, post_rots, post_trans)
 
         Returns:
-            torch.tensor: Bird-eye-view feature in shape (B, C, H_BEV, W_BEV)
+            tuple(torch.tensor): Bird-eye-view feature in shape (B, C, H_BEV,
+                W_BEV) and the depth distribution in shape (B*N, D, H, W).
+                With `fuse_depth_softmax`, the softmax is fused into the
+                pooling at inference and the depth logits are returned
+                instead.
         """
         x = input[0]
         B, N, C, H, W = x.shape
@@ -312,8 +741,11 @@ class LSSViewTransformerUQ(BaseModule):
 
         depth_digit = x[:, :self.D, ...]
         tran_feat = x[:, self.D:self.D + self.out_channels, ...]
+        if self.fuse_depth_softmax and not self.training:
+            # the probabilities are only consumed by the pooling at inference
+            return self.view_transform(
+                input, depth_digit, tran_feat, fused_softmax=True)
         depth = depth_digit.softmax(dim=1)
-        # print("hkj")
         return self.view_transform(input, depth, tran_feat)
 
     def get_mlp_input(self, rot, tran, intrin, post_rot, post_tran, bda):
@@ -359,6 +791,7 @@ class ASPP(nn.Module):
         super(ASPP, self).__init__()
 
         dilations = [1, 6, 12, 18]
+        self.mid_channels = mid_channels
 
         self.aspp1 = _ASPPModule(
             inplanes,
@@ -403,16 +836,18 @@ class ASPP(nn.Module):
         self._init_weight()
 
     def forward(self, x):
-        x1 = self.aspp1(x)
-        x2 = self.aspp2(x)
-        x3 = self.aspp3(x)
-        x4 = self.aspp4(x)
-        x5 = self.global_avg_pool(x)
-        x5 = F.interpolate(
-            x5, size=x4.size()[2:], mode='bilinear', align_corners=True)
-        x = torch.cat((x1, x2, x3, x4, x5), dim=1)
-
-        x = self.conv1(x)
+        # project each branch with its slice of conv1 and accumulate, which
+        # is equal to conv1 on the concatenated branches without the concat.
+        # The pooled branch is constant over space, so it is projected
+        # before being broadcast.
+        weights = self.conv1.weight.split(self.mid_channels, dim=1)
+        branches = (self.aspp1, self.aspp2, self.aspp3, self.aspp4)
+        x5 = F.conv2d(self.global_avg_pool(x), weights[4])
+        out = F.conv2d(branches[0](x), weights[0]) + x5
+        for branch, weight in zip(branches[1:], weights[1:4]):
+            out += F.conv2d(branch(x), weight)
+        x = out
+
         x = self.bn1(x)
         x = self.relu(x)
 
@@ -482,6 +917,7 @@ class DepthNet(nn.Module):
                  stereo=False,
                  bias=0.0,
                  aspp_mid_channels=-1,
+                 cv_group_size=4,
                  D = 100):
         super(DepthNet, self).__init__()
         
@@ -520,6 +956,7 @@ class DepthNet(nn.Module):
                     nn.BatchNorm2d(depth_channels)])
             self.cost_volumn_net = nn.Sequential(*cost_volumn_net)
             self.bias = bias
+            self.cv_group_size = cv_group_size
         depth_conv_list = [BasicBlock(depth_conv_input_channels, mid_channels,
                                       downsample=downsample),
                            BasicBlock(mid_channels, mid_channels),
@@ -583,18 +1020,73 @@ class DepthNet(nn.Module):
                 stride=1,
                 padding=0))
         self.uq_conv = nn.Sequential(*uq_conv_list)
+        # merged weights of the camera-aware branches, cached at inference
+        self._merged_weights = None
+
+    def train(self, mode=True):
+        self._merged_weights = None
+        return super(DepthNet, self).train(mode)
+
+    def _apply(self, fn):
+        # the cached weights do not follow the module across devices
+        self._merged_weights = None
+        return super(DepthNet, self)._apply(fn)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._merged_weights = None
+        super(DepthNet, self)._load_from_state_dict(*args, **kwargs)
+
+    def get_merged_weights(self):
+        """Get the weights of the merged camera-aware branches.
+
+        The per-branch weights are concatenated (fc1, SE convs) or stacked
+        (fc2) for the batched kernels, and the frozen BatchNorm1d is folded
+        into fc1. At inference without autograd this is done once, and the
+        result is reused until the module is switched to training, moved or
+        loaded with new weights, so only the merged kernels run per call.
+
+        Returns:
+            tuple(torch.Tensor): Weight and bias of the merged fc1, fc2, SE
+                reduce conv and SE expand conv.
+        """
+        cacheable = not self.training and not torch.is_grad_enabled()
+        if cacheable and self._merged_weights is not None:
+            return self._merged_weights
+        mlps = (self.context_mlp, self.depth_mlp, self.uq_mlp)
+        ses = (self.context_se, self.depth_se, self.uq_se)
+        fc1_weight = torch.cat([m.fc1.weight for m in mlps], dim=0)
+        fc1_bias = torch.cat([m.fc1.bias for m in mlps], dim=0)
+        if not self.bn.training:
+            # fold the frozen BatchNorm1d of the camera parameters into fc1
+            scale = self.bn.weight * torch.rsqrt(self.bn.running_var +
+                                                 self.bn.eps)
+            shift = self.bn.bias - scale * self.bn.running_mean
+            fc1_bias = fc1_bias + fc1_weight.mv(shift)
+            fc1_weight = fc1_weight * scale
+        merged_weights = (
+            fc1_weight, fc1_bias,
+            torch.stack([m.fc2.weight for m in mlps]).transpose(
+                1, 2).contiguous(),
+            torch.stack([m.fc2.bias for m in mlps]).unsqueeze(1),
+            torch.cat([m.conv_reduce.weight for m in ses], dim=0),
+            torch.cat([m.conv_reduce.bias for m in ses], dim=0),
+            torch.cat([m.conv_expand.weight for m in ses], dim=0),
+            torch.cat([m.conv_expand.bias for m in ses], dim=0))
+        if cacheable:
+            self._merged_weights = merged_weights
+        return merged_weights
 
     def gen_grid(self, metas, B, N, D, H, W, hi, wi):
         frustum = metas['frustum']
         points = frustum - metas['post_trans'].view(B, N, 1, 1, 1, 3)
-        points = torch.inverse(metas['post_rots']).view(B, N, 1, 1, 1, 3, 3) \
+        points = inverse_3x3(metas['post_rots']).view(B, N, 1, 1, 1, 3, 3) \
             .matmul(points.unsqueeze(-1))
         points = torch.cat(
             (points[..., :2, :] * points[..., 2:3, :], points[..., 2:3, :]), 5)
 
         rots = metas['k2s_sensor'][:, :, :3, :3].contiguous()
         trans = metas['k2s_sensor'][:, :, :3, 3].contiguous()
-        combine = rots.matmul(torch.inverse(metas['intrins']))
+        combine = rots.matmul(inverse_3x3(metas['intrins']))
 
         points = combine.view(B, N, 1, 1, 1, 3, 3).matmul(points)
         points += trans.view(B, N, 1, 1, 1, 3, 1)
@@ -616,7 +1108,7 @@ class DepthNet(nn.Module):
 
     def calculate_cost_volumn(self, metas):
         prev, curr = metas['cv_feat_list']
-        group_size = 4
+        group_size = self.cv_group_size
         _, c, hf, wf = curr.shape
         hi, wi = hf * 4, wf * 4
         B, N, _ = metas['post_trans'].shape
@@ -626,58 +1118,122 @@ class DepthNet(nn.Module):
         prev = prev.view(B * N, -1, H, W)
         curr = curr.view(B * N, -1, H, W)
         cost_volumn = 0
-        # process in group wise to save memory
-        for fid in range(curr.shape[1] // group_size):
+        # process in group wise to save memory, a larger group size means
+        # fewer and larger grid_sample calls at the cost of peak memory
+        num_groups = curr.shape[1] // group_size
+        for fid in range(num_groups):
             prev_curr = prev[:, fid * group_size:(fid + 1) * group_size, ...]
             wrap_prev = F.grid_sample(prev_curr, grid,
                                       align_corners=True,
                                       padding_mode='zeros')
+            wrap_prev = wrap_prev.view(B * N, -1, D, H, W)
+            if fid == num_groups - 1 and not self.bias == 0:
+                invalid = wrap_prev[:, 0, ...] == 0
             curr_tmp = curr[:, fid * group_size:(fid + 1) * group_size, ...]
-            cost_volumn_tmp = curr_tmp.unsqueeze(2) - \
-                              wrap_prev.view(B * N, -1, D, H, W)
-            cost_volumn_tmp = cost_volumn_tmp.abs().sum(dim=1)
-            cost_volumn += cost_volumn_tmp
+            # |curr - prev| in place on the sampled tensor
+            cost_volumn = cost_volumn + \
+                wrap_prev.sub_(curr_tmp.unsqueeze(2)).abs_().sum(dim=1)
         if not self.bias == 0:
-            invalid = wrap_prev[:, 0, ...].view(B * N, D, H, W) == 0
             cost_volumn[invalid] = cost_volumn[invalid] + self.bias
         cost_volumn = - cost_volumn
         cost_volumn = cost_volumn.softmax(dim=1)
         return cost_volumn
 
-    def forward(self, x, mlp_input, stereo_metas=None):
-        mlp_input = self.bn(mlp_input.reshape(-1, mlp_input.shape[-1]))
-        x = self.reduce_conv(x)
-        context_se = self.context_mlp(mlp_input)[..., None, None]
-        context = self.context_se(x, context_se)
-        context = self.context_conv(context)
-        depth_se = self.depth_mlp(mlp_input)[..., None, None]
+    def merged_camera_aware(self, x, mlp_input):
+        """Run the context, depth and uq camera-aware MLP and SE branches
+        as one batched matmul and one grouped conv per layer.
+
+        The parameters stay in the per-branch modules so that checkpoints
+        are unaffected.
 
-        # import ipdb;ipdb.set_trace()
+        Args:
+            x (torch.Tensor): Image feature in shape (B*N, C, H, W).
+            mlp_input (torch.Tensor): Camera parameters in shape (B*N, 27),
+                normalized by `self.bn` in training mode and raw otherwise,
+                as the frozen BatchNorm is then folded into the MLPs.
 
-        depth_input = x
+        Returns:
+            tuple(torch.Tensor): Context, depth and uq features re-weighted
+                by the camera-aware gates, each in shape (B*N, C, H, W).
+        """
+        mlps = (self.context_mlp, self.depth_mlp, self.uq_mlp)
+        ses = (self.context_se, self.depth_se, self.uq_se)
+        num_branch = len(mlps)
+        BN, C = x.shape[:2]
+        mlp = mlps[0]
+        (fc1_weight, fc1_bias, fc2_weight, fc2_bias, reduce_weight,
+         reduce_bias, expand_weight, expand_bias) = self.get_merged_weights()
+        x_se = F.linear(mlp_input, fc1_weight, fc1_bias)
+        x_se = mlp.drop1(mlp.act(x_se))
+        x_se = x_se.view(BN, num_branch, -1).transpose(0, 1)
+        x_se = torch.baddbmm(fc2_bias, x_se, fc2_weight)
+        x_se = mlp.drop2(x_se)
+        x_se = x_se.transpose(0, 1).reshape(BN, num_branch * C, 1, 1)
+
+        se = ses[0]
+        x_se = F.conv2d(x_se, reduce_weight, reduce_bias, groups=num_branch)
+        x_se = se.act1(x_se)
+        x_se = F.conv2d(x_se, expand_weight, expand_bias, groups=num_branch)
+        gates = se.gate(x_se).chunk(num_branch, dim=1)
+        return tuple(x * gate for gate in gates)
+
+    @staticmethod
+    def conv_adapt(convs, adapt, x):
+        """Run `convs` followed by the 1x1 `adapt` conv.
+
+        The last layer of `convs` is a 1x1 conv as well and there is no
+        activation in between, so both are folded into a single 1x1 conv
+        and the (B*N, depth_channels, H, W) intermediate is never built.
+        """
+        x = convs[:-1](x)
+        last, adapt_weight = convs[-1], adapt.weight.flatten(1)
+        weight = adapt_weight.mm(last.weight.flatten(1))
+        bias = adapt_weight.mv(last.bias) + adapt.bias
+        return F.conv2d(x, weight[..., None, None], bias)
 
-        depth = self.depth_se(depth_input, depth_se)      # TODO merge !!
+    def get_cost_volumn(self, x, stereo_metas=None):
+        """Get the raw stereo cost volume of the input features.
 
+        Args:
+            x (torch.Tensor): Image features in shape (B*N, C, H, W).
+            stereo_metas (dict | None): Stereo metas, None without stereo.
 
-        # UQ分支
-        uq_se = self.uq_mlp(mlp_input)[..., None, None]
-        uq_input = x
-        uq = self.uq_se(uq_input, uq_se)
+        Returns:
+            torch.Tensor | None: Cost volume in shape (B*N, D, H_cv, W_cv),
+                None without stereo.
+        """
+        if stereo_metas is None:
+            return None
+        if stereo_metas['cv_feat_list'][0] is None:
+            # reduce_conv keeps the spatial size of the input
+            BN, _, H, W = x.shape
+            scale_factor = float(stereo_metas['downsample'])/\
+                           stereo_metas['cv_downsample']
+            return torch.zeros((BN, self.depth_channels,
+                                int(H*scale_factor),
+                                int(W*scale_factor))).to(x)
+        with torch.no_grad():
+            return self.calculate_cost_volumn(stereo_metas)
 
+    def forward(self, x, mlp_input, stereo_metas=None):
+        return self.forward_head(x, mlp_input,
+                                 self.get_cost_volumn(x, stereo_metas))
 
+    def forward_head(self, x, mlp_input, cost_volumn=None):
+        """The depth net after the cost volume.
 
-        if not stereo_metas is None:
-            if stereo_metas['cv_feat_list'][0] is None:
-                BN, _, H, W = x.shape
-                scale_factor = float(stereo_metas['downsample'])/\
-                               stereo_metas['cv_downsample']
-                cost_volumn = \
-                    torch.zeros((BN, self.depth_channels,
-                                 int(H*scale_factor),
-                                 int(W*scale_factor))).to(x)
-            else:
-                with torch.no_grad():
-                    cost_volumn = self.calculate_cost_volumn(stereo_metas)
+        Unlike the cost volume, whose sampling grid is built with
+        data-dependent checks, this part only runs fixed-shape kernels and
+        can be captured in a CUDA graph.
+        """
+        mlp_input = mlp_input.reshape(-1, mlp_input.shape[-1])
+        if self.bn.training:
+            mlp_input = self.bn(mlp_input)
+        x = self.reduce_conv(x)
+        context, depth, uq = self.merged_camera_aware(x, mlp_input)
+        context = self.context_conv(context)
+
+        if cost_volumn is not None:
             cost_volumn = self.cost_volumn_net(cost_volumn)
             depth = torch.cat([depth, cost_volumn], dim=1)
 
@@ -685,12 +1241,11 @@ class DepthNet(nn.Module):
         if self.with_cp and False:
             depth = checkpoint(self.depth_conv, depth)
             uq = checkpoint(self.uq_conv, uq)
+            depth = self.depth_adapt(depth)
+            uq = self.uq_adapt(uq)
         else:
-            depth = self.depth_conv(depth)
-            uq = self.uq_conv(uq)
-
-        depth = self.depth_adapt(depth)
-        uq = self.uq_adapt(uq)
+            depth = self.conv_adapt(self.depth_conv, self.depth_adapt, depth)
+            uq = self.conv_adapt(self.uq_conv, self.uq_adapt, uq)
 
         # 返回 depth预测 + uncertainty预测 + context特征
         return torch.cat([depth, uq, context], dim=1)
@@ -704,8 +1259,10 @@ class DepthNet(nn.Module):
 class DepthAggregation(nn.Module):
     """pixel cloud feature extraction."""
 
-    def __init__(self, in_channels, mid_channels, out_channels):
+    def __init__(self, in_channels, mid_channels, out_channels,
+                 with_cp=False):
         super(DepthAggregation, self).__init__()
+        self.with_cp = with_cp
 
         self.reduce_conv = nn.Sequential(
             nn.Conv2d(
@@ -754,20 +1311,64 @@ class DepthAggregation(nn.Module):
 
     @autocast(False)
     def forward(self, x):
-        x = checkpoint(self.reduce_conv, x)
-        short_cut = x
-        x = checkpoint(self.conv, x)
-        x = short_cut + x
+        # BF16 keeps the range of FP32 while halving the activation traffic,
+        # which also makes checkpointing of the stack unnecessary. The
+        # residual add and the output conv stay in FP32.
+        if x.is_cuda and torch.cuda.is_bf16_supported():
+            amp_context = autocast(dtype=torch.bfloat16)
+        else:
+            amp_context = nullcontext()
+        with amp_context:
+            if self.with_cp:
+                x = checkpoint(self.reduce_conv, x)
+            else:
+                x = self.reduce_conv(x)
+            short_cut = x
+            x = self.conv(x)
+        x = short_cut.float() + x.float()
         x = self.out_conv(x)
         return x
 
 
 class LSSViewTransformerBEVDepthUQ(LSSViewTransformerUQ):
+    r"""View transformer with a Gaussian depth distribution and its
+    uncertainty predicted by `DepthNet`.
+
+    Args:
+        loss_depth_weight (float): Weight of the depth loss.
+        depthnet_cfg (dict): Extra arguments of `DepthNet`.
+        convnet_channels (tuple(int)): Channels of the first two layers of
+            the convnet on the depth and uncertainty maps. The defaults keep
+            the layout of the released checkpoints. As its input only has
+            two channels, a narrow first layer, e.g. (64, 128), is enough,
+            but needs training from scratch.
+        convnet_groups (int): Groups of the second layer of the convnet,
+            e.g. 4 together with convnet_channels=(64, 128). Values other
+            than 1 need training from scratch.
+        depth_topk (int, optional): Number of depth bins next to the
+            predicted mean that are splatted instead of the dense depth
+            distribution. None for the dense pooling.
+        use_head_cuda_graph (bool): Whether to replay the depth head from a
+            captured CUDA graph at inference.
+        **kwargs: Arguments of `LSSViewTransformerUQ`.
+    """
 
-    def __init__(self, loss_depth_weight=3.0, depthnet_cfg=dict(), 
-                **kwargs):
+    def __init__(self, loss_depth_weight=3.0, depthnet_cfg=dict(),
+                 convnet_channels=(512, 128), convnet_groups=1,
+                 depth_topk=None, use_head_cuda_graph=False, **kwargs):
         super(LSSViewTransformerBEVDepthUQ, self).__init__(**kwargs)
         self.loss_depth_weight = loss_depth_weight
+        # splat only the depth_topk bins next to the predicted mean instead
+        # of the dense depth distribution, None for the dense pooling
+        assert depth_topk is None or 0 < depth_topk <= self.D
+        self.depth_topk = depth_topk
+        # replay the depth head from a CUDA graph at inference, independent
+        # of `use_cuda_graph` of the view transformation
+        self.use_head_cuda_graph = use_head_cuda_graph
+        self._head_graph = None
+        self._head_graph_key = None
+        self._head_graph_inputs = None
+        self._head_graph_outputs = None
         self.depth_net = DepthNet(self.in_channels, self.in_channels,
                                   self.out_channels, self.D, **depthnet_cfg, 
                                 )
@@ -775,45 +1376,106 @@ class LSSViewTransformerBEVDepthUQ(LSSViewTransformerUQ):
         self.trans_feat_net=nn.Conv2d(self.out_channels*2, self.out_channels, 1, 1, 0)
 
 
+        mid1, mid2 = convnet_channels
         self.convnet=nn.Sequential(
-            nn.Conv2d(in_channels=2, out_channels=512, kernel_size=3, padding=1),
-            nn.BatchNorm2d(512),
+            nn.Conv2d(in_channels=2, out_channels=mid1, kernel_size=3, padding=1),
+            nn.BatchNorm2d(mid1),
             nn.ReLU(),
-            nn.Conv2d(in_channels=512, out_channels=128, kernel_size=3, padding=1),
-            nn.BatchNorm2d(128),
+            nn.Conv2d(in_channels=mid1, out_channels=mid2, kernel_size=3,
+                      padding=1, groups=convnet_groups),
+            nn.BatchNorm2d(mid2),
             nn.ReLU(),
-            nn.Conv2d(in_channels=128, out_channels=32, kernel_size=3, padding=1),
+            nn.Conv2d(in_channels=mid2, out_channels=32, kernel_size=3, padding=1),
             nn.BatchNorm2d(32),
             nn.ReLU(),
             nn.Conv2d(in_channels=32, out_channels=32, kernel_size=3, padding=1),
             # nn.Sigmoid()
         )   
+        # the convs on the narrow depth-uq feature pick the faster NHWC
+        # kernels of cuDNN in channels_last
+        self.convnet.to(memory_format=torch.channels_last)
+        self.trans_feat_net.to(memory_format=torch.channels_last)
+
+        # scalars of the depth head, kept as buffers so that they are not
+        # uploaded from the host in every forward pass
+        depth_cfg = self.grid_config['depth']
+        self.register_buffer('_log_dmin',
+                             torch.tensor(math.log(depth_cfg[0])),
+                             persistent=False)
+        self.register_buffer(
+            '_log_dratio',
+            torch.tensor(math.log((depth_cfg[1] - 1.) / depth_cfg[0])),
+            persistent=False)
+        # depth bin indices [0,1,...,D-1]
+        self.register_buffer('_depth_bins', torch.arange(self.D).float(),
+                             persistent=False)
+        self._depth_bins_cast = dict()
 
 
     
 
 
+    def get_depth_bins(self, dtype):
+        """Get the depth bin indices in the given dtype.
+
+        The casts are cached per dtype and device, so that the bins are not
+        converted again in every forward pass under autocast.
+
+        Args:
+            dtype (torch.dtype): Dtype of the tensors they are used with.
+
+        Returns:
+            torch.Tensor: Depth bin indices in shape (D).
+        """
+        if self._depth_bins.dtype == dtype:
+            return self._depth_bins
+        key = (dtype, self._depth_bins.device)
+        depth_bins = self._depth_bins_cast.get(key)
+        if depth_bins is None:
+            depth_bins = self._depth_bins.to(dtype)
+            self._depth_bins_cast[key] = depth_bins
+        return depth_bins
+
+    def merge_trans_feat(self, tran_feat, depth_uq_feat):
+        """Equivalent of `trans_feat_net` on the concatenation of
+        `tran_feat` and `convnet(depth_uq_feat)`.
+
+        The 1x1 `trans_feat_net` is split along its input channels, and its
+        half for the depth-uq feature is folded into the last 3x3 conv of
+        `convnet`, as there is no activation in between. This avoids the
+        concatenation and one conv.
+        """
+        C = tran_feat.shape[1]
+        weight = self.trans_feat_net.weight.flatten(1)
+        feat_weight, uq_weight = weight[:, :C], weight[:, C:]
+        last = self.convnet[-1]
+        fused_weight = torch.einsum(
+            'oc,cikl->oikl', uq_weight,
+            last.weight).contiguous(memory_format=torch.channels_last)
+        fused_bias = uq_weight.mv(last.bias) + self.trans_feat_net.bias
+        depth_uq_feat = F.conv2d(
+            self.convnet[:-1](depth_uq_feat), fused_weight, fused_bias,
+            padding=last.padding)
+        return F.conv2d(tran_feat, feat_weight[..., None, None]) + \
+            depth_uq_feat
+
     def get_mlp_input(self, sensor2ego, ego2global, intrin, post_rot, post_tran, bda):
         B, N, _, _ = sensor2ego.shape
-        bda = bda.view(B, 1, 3, 3).repeat(1, N, 1, 1)
-        mlp_input = torch.stack([
-            intrin[:, :, 0, 0],
-            intrin[:, :, 1, 1],
-            intrin[:, :, 0, 2],
-            intrin[:, :, 1, 2],
-            post_rot[:, :, 0, 0],
-            post_rot[:, :, 0, 1],
-            post_tran[:, :, 0],
-            post_rot[:, :, 1, 0],
-            post_rot[:, :, 1, 1],
-            post_tran[:, :, 1],
-            bda[:, :, 0, 0],
-            bda[:, :, 0, 1],
-            bda[:, :, 1, 0],
-            bda[:, :, 1, 1],
-            bda[:, :, 2, 2],], dim=-1)
-        sensor2ego = sensor2ego[:,:,:3,:].reshape(B, N, -1)
-        mlp_input = torch.cat([mlp_input, sensor2ego], dim=-1)
+        # only read below, so a broadcast view is enough
+        bda = bda.view(B, 1, 3, 3).expand(B, N, 3, 3)
+        # gather the entries with views of contiguous blocks and a single
+        # cat, instead of stacking 15 scalar slices. The order is fx, fy,
+        # cx, cy, the first two rows of [post_rot | post_tran], the upper
+        # left 2x2 block and the z scale of bda, and sensor2ego[:3].
+        post_aug = torch.cat([post_rot[:, :, :2, :2],
+                              post_tran[:, :, :2, None]], dim=-1)
+        mlp_input = torch.cat([
+            torch.diagonal(intrin[:, :, :2, :2], dim1=-2, dim2=-1),
+            intrin[:, :, :2, 2],
+            post_aug.reshape(B, N, 6),
+            bda[:, :, :2, :2].reshape(B, N, 4),
+            bda[:, :, 2:, 2],
+            sensor2ego[:, :, :3, :].reshape(B, N, 12)], dim=-1)
         return mlp_input
 
     # def get_downsampled_gt_depth(self, gt_depths):
@@ -855,54 +1517,37 @@ class LSSViewTransformerBEVDepthUQ(LSSViewTransformerUQ):
     #     return gt_depths.float()
     
 
-    def get_downsampled_gt_depth(self, gt_depths, for_uncertainty=False):
+    def get_downsampled_gt_bins(self, gt_depths):
         """
         Input:
             gt_depths: [B, N, H, W]
-            for_uncertainty: bool, 是否用于uncertainty学习
         Output:
-            gt_depths: 
-                if for_uncertainty: [B*N*h*w] 标准化的真实深度值
-                else: [B*N*h*w, d] one-hot形式
+            gt_depths: [B*N, h, w] bin单位的真实深度, 无效处为0
         """
-        B, N, H, W = gt_depths.shape
-        gt_depths = gt_depths.view(B * N, H // self.downsample,
-                                self.downsample, W // self.downsample,
-                                self.downsample, 1)
-        gt_depths = gt_depths.permute(0, 1, 3, 5, 2, 4).contiguous()
-        gt_depths = gt_depths.view(-1, self.downsample * self.downsample)
-        gt_depths_tmp = torch.where(gt_depths == 0.0,
-                                    1e5 * torch.ones_like(gt_depths),
-                                    gt_depths)
-        gt_depths = torch.min(gt_depths_tmp, dim=-1).values
-        gt_depths = gt_depths.view(B * N, H // self.downsample,
-                                W // self.downsample)
-
-        # 标准化深度值
-        if not self.sid:
-            gt_depths = (gt_depths - (self.grid_config['depth'][0] -
-                                    self.grid_config['depth'][2])) / \
-                        self.grid_config['depth'][2]
-        else:
-            gt_depths = torch.log(gt_depths) - torch.log(
-                torch.tensor(self.grid_config['depth'][0]).float())
-            gt_depths = gt_depths * (self.D - 1) / torch.log(
-                torch.tensor(self.grid_config['depth'][1] - 1.).float() /
-                self.grid_config['depth'][0])
-            gt_depths = gt_depths + 1.
-
-        gt_depths = torch.where((gt_depths < self.D) & (gt_depths >= 0.0),
-                                gt_depths, torch.zeros_like(gt_depths))
-        gt_depths=gt_depths/torch.tensor(self.D).to(device=gt_depths.device, dtype=gt_depths.dtype)
-
-        if not for_uncertainty:
-            # 用于原始depth学习，转one-hot
-            gt_depths = F.one_hot(
-                gt_depths.long(), num_classes=self.D + 1).view(-1, self.D + 1)[:,1:]
-            return gt_depths.float()
-        else:
-            # 用于uncertainty学习，返回标准化的真实值
-            return gt_depths.reshape(-1)
+        # 下采样并转换为bin单位, 由scripted函数完成
+        return _downsample_gt(gt_depths, self.downsample, self.D,
+                              self.grid_config['depth'][0],
+                              self.grid_config['depth'][2], self.sid,
+                              self._log_dmin, self._log_dratio)
+
+    def get_downsampled_gt_depth(self, gt_depths):
+        """
+        Input:
+            gt_depths: [B, N, H, W]
+        Output:
+            gt_depths: [B*N*h*w, d] one-hot形式, 用于原始depth学习
+        """
+        return _depth_onehot(self.get_downsampled_gt_bins(gt_depths), self.D)
+
+    def get_downsampled_gt_depth_regression(self, gt_depths):
+        """
+        Input:
+            gt_depths: [B, N, H, W]
+        Output:
+            gt_depths: [B*N*h*w] 标准化的真实深度值, 用于uncertainty学习
+        """
+        gt_depths = self.get_downsampled_gt_bins(gt_depths)
+        return (gt_depths / float(self.D)).reshape(-1)
 
     def recover_regression_from_pred(self, pred, grid_config, sid=False):
         """
@@ -911,21 +1556,21 @@ class LSSViewTransformerBEVDepthUQ(LSSViewTransformerUQ):
         Output:
             depth: [B, H, W] - 还原的深度图
         """
-        # 生成深度值序列 [D] 
-        depth_indices = torch.arange(pred.shape[1], device=pred.device)
+        # 深度值序列 [D], 缓存的buffer
+        depth_indices = self.get_depth_bins(pred.dtype)
         
-        # 把深度索引扩展为 [1,D,1,1] 以便做广播乘法
-        depth_indices = depth_indices.view(1, -1, 1, 1)
-        
-        # 加权求和得到预测深度指数 [B,H,W]
-        pred_depth = torch.sum(pred * depth_indices, dim=1)  
+        # 沿D加权求和得到预测深度指数 [B,H,W]. [1,1,D] @ [B,D,H*W]直接在pred原有的
+        # 内存布局上做batched gemv, 既没有[B,D,H,W]的乘积, 也没有einsum内部的permute拷贝
+        B, _, H, W = pred.shape
+        pred_depth = torch.matmul(depth_indices.view(1, 1, -1),
+                                  pred.flatten(2)).view(B, H, W)
         
         # 还原真实深度值
         if not sid:
             depth = pred_depth * grid_config['depth'][2] + (grid_config['depth'][0] - grid_config['depth'][2])
         else:
             depth = torch.exp(
-                (pred_depth - 1) * torch.log(torch.tensor(grid_config['depth'][1] - 1.).float() / grid_config['depth'][0]) / (D - 1)
+                (pred_depth - 1) * self._log_dratio.to(pred_depth.dtype) / (self.D - 1)
             ) * grid_config['depth'][0]
             
         return depth  # [B,H,W]
@@ -947,35 +1592,30 @@ class LSSViewTransformerBEVDepthUQ(LSSViewTransformerUQ):
     #     depth_loss = depth_loss.sum() / max(1.0, fg_mask.sum())
     #     return self.loss_depth_weight * depth_loss
 
-    @force_fp32()
     def get_depth_loss(self, depth_labels, depth_preds):
         depth = depth_preds[0]    
         logvar = depth_preds[1]   
         
         # 获取标准化的真实深度值
-        gt_depth = self.get_downsampled_gt_depth(depth_labels, for_uncertainty=True)  
+        gt_depth = self.get_downsampled_gt_depth_regression(depth_labels)  
         
         # reshape预测值
         depth = depth.reshape(-1)   
         logvar = logvar.reshape(-1)
         
-        # 获取前景mask
-        fg_mask = gt_depth > 0.0
+        # 获取前景mask, 只做一次nonzero, 三个tensor共用同一组索引
+        fg_idx = (gt_depth > 0.0).nonzero(as_tuple=True)[0]
         
-        # 应用mask
-        self_D=torch.tensor(self.D).to(device=logvar.device, dtype=logvar.dtype)
-        # depth = depth[fg_mask]
-        depth = depth[fg_mask]*self_D
+        # 应用mask, 预测值保持原有精度(FP16/BF16), 在scripted函数中才转为FP32
+        self_D = float(self.D)
+        depth = depth.index_select(0, fg_idx)
         # logvar = logvar[fg_mask]-torch.log(self_D*self_D)
-        logvar = logvar[fg_mask]
-        logvar = logvar.clamp(min=-10)  
-        # gt_depth = gt_depth[fg_mask]
-        gt_depth = gt_depth[fg_mask]*self_D
+        logvar = logvar.index_select(0, fg_idx)
+        gt_depth = gt_depth.index_select(0, fg_idx)
         
-        # 计算KL散度loss
+        # 计算KL散度loss, logvar的clamp在scripted函数中完成
         # loss = ((gt_depth - depth)**2 + logvar/2).mean()
-        smooth_value=F.smooth_l1_loss(depth, gt_depth, beta=1.0, reduction='none')
-        loss = ((   smooth_value    * torch.exp(-logvar))/2 + logvar/2).mean()
+        loss = _uq_loss(depth, logvar, gt_depth, self_D, 1.0)
         
         return self.loss_depth_weight * loss
 
@@ -990,37 +1630,164 @@ class LSSViewTransformerBEVDepthUQ(LSSViewTransformerUQ):
         输出:
             depth_prob: [B,D,H,W] tensor, 每个位置上的深度概率分布
         """
-        B, H, W = depth_mean.shape
-        
-        # 生成深度值序列 [0,1,2,...,D-1]
-        depth_bins = torch.arange(num_depth_bins, device=depth_mean.device, dtype=depth_mean.dtype)
-        
-        # 将深度值序列扩展为 [1,D,1,1] 以便broadcasting
-        depth_bins = depth_bins.view(1, -1, 1, 1)
-        
-        # 将mean和logvar扩展为 [B,1,H,W] 以便broadcasting
-        depth_mean = depth_mean.unsqueeze(1)*torch.tensor(num_depth_bins).to(depth_mean.device)  # [B,1,H,W]
-        logvar = logvar.unsqueeze(1)          # [B,1,H,W]
-        
-        # 计算正态分布概率
-        # v = 2logσ, 所以 σ^2 = exp(v)
-        variance = torch.exp(logvar)  # 从v转回variance
-        
-        # 把2*pi转成tensor
-        pi = torch.tensor(torch.pi, device=depth_mean.device, dtype=depth_mean.dtype)
-        
-        # 使用log-space计算避免数值问题
-        log_prob = -0.5 * (torch.log(2 * pi) + logvar) - \
-                0.5 * (depth_bins - depth_mean).pow(2) / (variance + eps)
-        
-        # 转换回probability space并归一化
-        prob = torch.exp(log_prob)
-        depth_prob = prob / (torch.sum(prob, dim=1, keepdim=True) + eps)
-        
-        return depth_prob  # [B,D,H,W]
+        # 深度值序列 [0,1,2,...,D-1], 缓存的buffer
+        if num_depth_bins == self.D:
+            depth_bins = self.get_depth_bins(depth_mean.dtype)
+        else:
+            depth_bins = torch.arange(num_depth_bins, device=depth_mean.device, dtype=depth_mean.dtype)
+
+        # 正态分布概率在log-space计算, 由scripted函数融合, 并用softmax归一化
+        return _gauss_depth_prob(depth_mean, logvar,
+                                 depth_bins.view(1, -1, 1, 1),
+                                 float(num_depth_bins), eps)
+
+
+
+
+    @torch.no_grad()
+    def get_voxel_index(self, input):
+        """Get the flat index of the BEV voxel of every frustum point.
+
+        Like the pooling ranks, the index is cached per calibration if
+        `use_cached_ranks`.
+
+        Args:
+            input (list(torch.tensor)): Inputs of the view transformer.
+
+        Returns:
+            torch.tensor: Voxel index in shape (B, N, D, H, W). Points
+                outside the grid index an extra voxel after the last one.
+        """
+        entry = None
+        if self.use_cached_ranks:
+            entry = self._get_calib_cache((input[1], ) + tuple(input[3:7]))
+            if 'voxel_index' in entry:
+                return entry['voxel_index']
+        coor = self.get_lidar_coor(*input[1:7])
+        B = coor.shape[0]
+        X, Y, Z = self._grid_size_int
+        # truncated to the voxel the same way as `voxel_pooling_prepare_v2`
+        coor = ((coor - self.grid_lower_bound.to(coor)) /
+                self.grid_interval.to(coor)).long()
+        kept = ((coor >= 0) & (coor < self.grid_size.to(coor))).all(dim=-1)
+        batch_idx = torch.arange(B, device=coor.device).view(B, 1, 1, 1, 1)
+        voxel_index = ((batch_idx * Z + coor[..., 2]) * Y +
+                       coor[..., 1]) * X + coor[..., 0]
+        voxel_index = voxel_index.masked_fill(~kept, B * Z * Y * X)
+        if entry is not None:
+            entry['voxel_index'] = voxel_index
+        return voxel_index
+
+    def sparse_view_transform(self, input, depth_mean, logvar, tran_feat,
+                              eps=1e-6):
+        """Splat the features with only the most probable depth bins.
+
+        The Gaussian depth distribution is unimodal, so its `depth_topk`
+        most probable bins are the ones next to the mean. Only these are
+        evaluated, renormalized and scattered into the BEV grid, and the
+        dense (B*N, D, H, W) distribution is never built.
 
+        Args:
+            input (list(torch.tensor)): Inputs of the view transformer.
+            depth_mean (torch.tensor): Normalized depth mean in shape
+                (B*N, H, W).
+            logvar (torch.tensor): Log variance in shape (B*N, H, W).
+            tran_feat (torch.tensor): Image features in shape (B*N, C, H, W).
 
+        Returns:
+            torch.tensor: Bird-eye-view feature in the same shape as
+                `view_transform`.
+        """
+        B, N, _, H, W = input[0].shape
+        C = tran_feat.shape[1]
+        K = self.depth_topk
+        X, Y, Z = self._grid_size_int
+        voxel_index = self.get_voxel_index(input).view(B * N, self.D, H, W)
+
+        with torch.no_grad():
+            start = (depth_mean * self.D - (K - 1) / 2).round().long()
+            start = start.clamp(0, self.D - K).unsqueeze(1)
+            bins = start + torch.arange(
+                K, device=start.device).view(1, K, 1, 1)
+        prob = _gauss_depth_prob(depth_mean, logvar, bins.to(depth_mean),
+                                 float(self.D), eps)  # (B*N, K, H, W)
+        index = voxel_index.gather(1, bins)
+
+        # (B*N, K, H, W, C) contributions of the selected points
+        feat = tran_feat.permute(0, 2, 3, 1).unsqueeze(1)
+        feat = prob.unsqueeze(-1).to(feat) * feat
+        num_voxels = B * Z * Y * X
+        bev_feat = feat.new_zeros(num_voxels + 1, C)
+        bev_feat = bev_feat.index_add(0, index.flatten(), feat.reshape(-1, C))
+        bev_feat = bev_feat[:num_voxels].view(B, Z, Y, X, C)
+        bev_feat = bev_feat.permute(0, 4, 1, 2, 3)
+        # collapse Z the same way as `voxel_pooling_v2`
+        if self.collapse_z:
+            bev_feat = bev_feat.transpose(1, 2).reshape(B, Z * C, Y, X)
+        else:
+            bev_feat = bev_feat.contiguous()
+        return bev_feat
+
+    def depth_head(self, x, mlp_input, cost_volumn=None):
+        """Predict the depth, uq and context feature from the image
+        features, and the dense depth distribution if it is pooled.
+
+        Args:
+            x (torch.Tensor): Image features in shape (B*N, C, H, W).
+            mlp_input (torch.Tensor): Camera-aware MLP input.
+            cost_volumn (torch.Tensor | None): Raw stereo cost volume.
+
+        Returns:
+            tuple(torch.Tensor): Depth and uq in shape (B*N, H, W), context
+                feature in shape (B*N, C, H, W) and, if `depth_topk` is
+                None, the depth distribution in shape (B*N, D, H, W).
+        """
+        x = self.depth_net.forward_head(x, mlp_input, cost_volumn)
+        depth_digit, uq_digit, tran_feat = x.split(
+            [1, 1, self.out_channels], dim=1)
+        uq = uq_digit.squeeze(dim=1).clamp(min=-10)  # [12,26,44]
+        depth = depth_digit.squeeze(dim=1).sigmoid()  # [12,26,44]
 
+        # stacked along the last dim, the permuted view is channels_last
+        depth_uq_feat = torch.stack([depth.detach(), uq.detach()],
+                                    dim=-1).permute(0, 3, 1, 2)
+        tran_feat = self.merge_trans_feat(tran_feat, depth_uq_feat)
+        if self.depth_topk is not None:
+            return depth, uq, tran_feat
+        depth_distribution = self.generate_depth_distribution(
+            depth, uq, num_depth_bins=self.D)
+        return depth, uq, tran_feat, depth_distribution
+
+    def graphed_depth_head(self, x, mlp_input, cost_volumn=None):
+        """`depth_head` replayed from a CUDA graph.
+
+        The graph is captured on static copies of the inputs and re-captured
+        when their shapes change. It is only used outside of autocast, whose
+        cast cache would be shared with the captured kernels. If the replay
+        does not match the eager result, the graph is disabled.
+        """
+        inputs = (x, mlp_input)
+        if cost_volumn is not None:
+            inputs += (cost_volumn, )
+        key = tuple((tuple(t.shape), t.dtype) for t in inputs)
+        if self._head_graph is None or self._head_graph_key != key:
+            self._head_graph = None
+            static_inputs = tuple(t.clone() for t in inputs)
+            graph, static_outputs = _capture_cuda_graph(
+                self.depth_head, static_inputs)
+            if graph is None:
+                warnings.warn('The CUDA graph of the depth head does not '
+                              'match the eager result, it is disabled.')
+                self.use_head_cuda_graph = False
+                return self.depth_head(x, mlp_input, cost_volumn)
+            self._head_graph, self._head_graph_key = graph, key
+            self._head_graph_inputs = static_inputs
+            self._head_graph_outputs = static_outputs
+        for static_input, cur_input in zip(self._head_graph_inputs, inputs):
+            static_input.copy_(cur_input)
+        self._head_graph.replay()
+        # the static outputs are overwritten by the next replay
+        return tuple(t.clone() for t in self._head_graph_outputs)
 
     def forward(self, input, stereo_metas=None, depth_gt=None):
         (x, rots, trans, intrins, post_rots, post_trans, bda,
@@ -1031,40 +1798,22 @@ class LSSViewTransformerBEVDepthUQ(LSSViewTransformerUQ):
 
         
 
-        x = self.depth_net(x, mlp_input, stereo_metas) #torch.Size([12, 120, 32, 88])=  torch.Size([12, 512, 32, 88]) torch.Size([2, 6, 27])
-        depth_digit = x[:, :1, ...]  #torch.Size([12, 120, 32, 88])
-        uq_digit = x[:, 1:2, ...] #torch.Size([12, 120, 32, 88])
-        tran_feat = x[:, 2:2 + self.out_channels, ...]
-        # depth = depth_digit.softmax(dim=1) #torch.Size([12, 88, 32, 88])
-        
-        # raise NotImplementedError()
-
-        # depth=self.recover_regression_from_pred(depth, self.grid_config)#[12, 26, 44]
-        # uq=uq_digit.sum(dim=1)
-        uq=uq_digit.squeeze(dim=1)
-
-        depth = depth_digit.squeeze(dim=1).sigmoid()  # [12,26,44]
-        uq = uq.clamp(min=-10)  # [12,26,44] torch tensor用clamp        # [12,26,44]
-        depth_distribution = self.generate_depth_distribution(depth, uq, num_depth_bins=self.D)  # [12,88,26,44]
-
-        a=0
-        # depth_digit = x[:, :1, ...]
-        # uq_digit = x[:, 1:2, ...]
-        # tran_feat = x[:, 2:2 + self.out_channels, ...]
-        # depth = depth_digit.softmax(dim=1)
-        # depth = depth_digit.sigmoid()*88
-        
-        # tran_feat depth  uq
-
-        depth_uq_feat = torch.cat([depth.unsqueeze(dim=1), uq.unsqueeze(dim=1)], dim=1).detach()
-        depth_uq_feat = self.convnet(depth_uq_feat)
-        trans_feat = torch.cat([tran_feat, 
-                                depth_uq_feat
-                                ], dim=1)
-        
-        tran_feat = self.trans_feat_net(trans_feat)
+        # the cost volume is built eagerly, the rest of the depth head has
+        # static shapes and is replayed from a CUDA graph at inference
+        cost_volumn = self.depth_net.get_cost_volumn(x, stereo_metas)
+        if self.use_head_cuda_graph and not self.training and x.is_cuda and \
+                not torch.is_autocast_enabled():
+            head_outs = self.graphed_depth_head(x, mlp_input, cost_volumn)
+        else:
+            head_outs = self.depth_head(x, mlp_input, cost_volumn)
+        depth, uq, tran_feat = head_outs[:3]
 
+        if self.depth_topk is not None:
+            # 只splat均值附近的depth_topk个bins, 不生成稠密的深度分布
+            bev_feat = self.sparse_view_transform(input, depth, uq, tran_feat)
+            return bev_feat, [depth, uq]
 
+        depth_distribution = head_outs[3]  # [12,88,26,44]
         # bev_feat, depth = self.view_transform(input, depth, tran_feat) #torch.Size([2, 32, 16, 200, 200]) torch.Size([12, 88, 32, 88])
         bev_feat, depth_ret = self.view_transform(input, depth_distribution, tran_feat) #torch.Size([2, 32, 16, 200, 200]) torch.Size([12, 88, 32, 88])
         return bev_feat, [depth, uq]  # depth_digit.sigmoid()
@@ -5,7 +5,7 @@ import torch
 
 from . import bev_pool_v2_ext
 
-__all__ = ['bev_pool_v2', 'TRTBEVPoolv2']
+__all__ = ['bev_pool_v2', 'quantized_bev_pool_v2', 'TRTBEVPoolv2']
 
 
 class QuickCumsumCuda(torch.autograd.Function):
@@ -43,51 +43,155 @@ class QuickCumsumCuda(torch.autograd.Function):
     @staticmethod
     def backward(ctx, out_grad):
         ranks_bev, depth, feat, ranks_feat, ranks_depth = ctx.saved_tensors
+        depth_grad, feat_grad = _bev_pool_v2_backward(
+            out_grad, depth, feat, ranks_depth, ranks_feat, ranks_bev)
+        return depth_grad, feat_grad, None, None, None, None, None, \
+            None, None, None
+
 
-        order = ranks_feat.argsort()
-        ranks_feat, ranks_depth, ranks_bev = \
-            ranks_feat[order], ranks_depth[order], ranks_bev[order]
-        kept = torch.ones(
-            ranks_bev.shape[0], device=ranks_bev.device, dtype=torch.bool)
-        kept[1:] = ranks_feat[1:] != ranks_feat[:-1]
-        interval_starts_bp = torch.where(kept)[0].int()
-        interval_lengths_bp = torch.zeros_like(interval_starts_bp)
-        interval_lengths_bp[:-1] = interval_starts_bp[
-            1:] - interval_starts_bp[:-1]
-        interval_lengths_bp[-1] = ranks_bev.shape[0] - interval_starts_bp[-1]
-
-        depth = depth.contiguous()
-        feat = feat.contiguous()
-        ranks_depth = ranks_depth.contiguous()
-        ranks_feat = ranks_feat.contiguous()
-        ranks_bev = ranks_bev.contiguous()
-        interval_lengths_bp = interval_lengths_bp.contiguous()
-        interval_starts_bp = interval_starts_bp.contiguous()
-
-        depth_grad = depth.new_zeros(depth.shape)
-        feat_grad = feat.new_zeros(feat.shape)
-        out_grad = out_grad.contiguous()
-        bev_pool_v2_ext.bev_pool_v2_backward(
-            out_grad,
-            depth_grad,
-            feat_grad,
+class QuickCumsumSoftmaxCuda(torch.autograd.Function):
+    r"""BEVPoolv2 with the softmax of the depth logits fused into the pooling.
+
+    The depth probabilities are computed on the fly from the logits and
+    their logsumexp along the depth axis, so that the (B, N, D, H, W) depth
+    distribution is never written in the forward pass.
+    """
+    @staticmethod
+    def forward(ctx, depth, feat, ranks_depth, ranks_feat, ranks_bev,
+                bev_feat_shape, interval_starts, interval_lengths):
+        ranks_bev = ranks_bev.int()
+        depth = depth.contiguous().float()
+        depth_lse = depth.logsumexp(dim=2).contiguous()
+        feat = feat.contiguous().float()
+        ranks_depth = ranks_depth.contiguous().int()
+        ranks_feat = ranks_feat.contiguous().int()
+        interval_lengths = interval_lengths.contiguous().int()
+        interval_starts = interval_starts.contiguous().int()
+
+        out = feat.new_zeros(bev_feat_shape)
+
+        bev_pool_v2_ext.bev_pool_v2_softmax_forward(
             depth,
+            depth_lse,
             feat,
+            out,
             ranks_depth,
             ranks_feat,
             ranks_bev,
-            interval_lengths_bp,
-            interval_starts_bp,
+            interval_lengths,
+            interval_starts,
         )
+
+        ctx.save_for_backward(ranks_bev, depth, depth_lse, feat, ranks_feat,
+                              ranks_depth)
+        return out
+
+    @staticmethod
+    def backward(ctx, out_grad):
+        ranks_bev, depth, depth_lse, feat, ranks_feat, ranks_depth = \
+            ctx.saved_tensors
+        prob = torch.exp(depth - depth_lse.unsqueeze(2))
+        prob_grad, feat_grad = _bev_pool_v2_backward(
+            out_grad, prob, feat, ranks_depth, ranks_feat, ranks_bev)
+        # backward of the softmax along the depth axis
+        depth_grad = prob * (
+            prob_grad - (prob_grad * prob).sum(dim=2, keepdim=True))
         return depth_grad, feat_grad, None, None, None, None, None, \
             None, None, None
 
 
+def _bev_pool_v2_backward(out_grad, depth, feat, ranks_depth, ranks_feat,
+                          ranks_bev):
+    order = ranks_feat.argsort()
+    ranks_feat, ranks_depth, ranks_bev = \
+        ranks_feat[order], ranks_depth[order], ranks_bev[order]
+    kept = torch.ones(
+        ranks_bev.shape[0], device=ranks_bev.device, dtype=torch.bool)
+    kept[1:] = ranks_feat[1:] != ranks_feat[:-1]
+    interval_starts_bp = torch.where(kept)[0].int()
+    interval_lengths_bp = torch.zeros_like(interval_starts_bp)
+    interval_lengths_bp[:-1] = interval_starts_bp[
+        1:] - interval_starts_bp[:-1]
+    interval_lengths_bp[-1] = ranks_bev.shape[0] - interval_starts_bp[-1]
+
+    depth = depth.contiguous()
+    feat = feat.contiguous()
+    ranks_depth = ranks_depth.contiguous()
+    ranks_feat = ranks_feat.contiguous()
+    ranks_bev = ranks_bev.contiguous()
+    interval_lengths_bp = interval_lengths_bp.contiguous()
+    interval_starts_bp = interval_starts_bp.contiguous()
+
+    depth_grad = depth.new_zeros(depth.shape)
+    feat_grad = feat.new_zeros(feat.shape)
+    out_grad = out_grad.contiguous()
+    bev_pool_v2_ext.bev_pool_v2_backward(
+        out_grad,
+        depth_grad,
+        feat_grad,
+        depth,
+        feat,
+        ranks_depth,
+        ranks_feat,
+        ranks_bev,
+        interval_lengths_bp,
+        interval_starts_bp,
+    )
+    return depth_grad, feat_grad
+
+
+@torch.no_grad()
+def quantized_bev_pool_v2(depth, feat, ranks_depth, ranks_feat, ranks_bev,
+                          bev_feat_shape, interval_starts, interval_lengths):
+    """BEVPoolv2 on INT8 inputs for inference.
+
+    The depth probabilities are quantized to uint8 with a scale of 1/255 and
+    the features to int8 with a symmetric per-channel scale. The products
+    are accumulated in int32 and dequantized once per output element.
+    """
+    depth = (depth.float() * 255).round_().clamp_(0, 255).to(torch.uint8)
+    feat = feat.float()
+    feat_absmax = feat.abs().flatten(0, -2).amax(dim=0).clamp_(min=1e-6)
+    feat = (feat * (127 / feat_absmax)).round_().to(torch.int8)
+    scale = (feat_absmax / (127 * 255)).contiguous()
+
+    out = scale.new_zeros(bev_feat_shape)
+    bev_pool_v2_ext.bev_pool_v2_int8_forward(
+        depth.contiguous(),
+        feat.contiguous(),
+        scale,
+        out,
+        ranks_depth.contiguous().int(),
+        ranks_feat.contiguous().int(),
+        ranks_bev.contiguous().int(),
+        interval_lengths.contiguous().int(),
+        interval_starts.contiguous().int(),
+    )
+    return out
+
+
 def bev_pool_v2(depth, feat, ranks_depth, ranks_feat, ranks_bev,
-                bev_feat_shape, interval_starts, interval_lengths):
-    x = QuickCumsumCuda.apply(depth, feat, ranks_depth, ranks_feat, ranks_bev,
-                              bev_feat_shape, interval_starts,
-                              interval_lengths)
+                bev_feat_shape, interval_starts, interval_lengths,
+                fused_softmax=False, quantize=False):
+    """BEVPoolv2 entry.
+
+    If ``fused_softmax`` is set, ``depth`` holds the depth logits in shape
+    (B, N, D, H, W) and the softmax along D is computed inside the kernel.
+    If ``quantize`` is set, the pooling runs on INT8 inputs without
+    gradient, see `quantized_bev_pool_v2`.
+    """
+    if quantize:
+        if fused_softmax:
+            depth = depth.softmax(dim=2)
+        x = quantized_bev_pool_v2(depth, feat, ranks_depth, ranks_feat,
+                                  ranks_bev, bev_feat_shape, interval_starts,
+                                  interval_lengths)
+    else:
+        pool_func = \
+            QuickCumsumSoftmaxCuda if fused_softmax else QuickCumsumCuda
+        x = pool_func.apply(depth, feat, ranks_depth, ranks_feat, ranks_bev,
+                            bev_feat_shape, interval_starts,
+                            interval_lengths)
     x = x.permute(0, 4, 1, 2, 3).contiguous()
     return x
 
@@ -174,3 +278,50 @@ def test_bev_pool_v2():
     grad_feat = np.array([1.0, 1.0, 0.4, 0.4, 0.8, 0.8, 0., 0.])
     grad_feat = torch.from_numpy(grad_feat).float().cuda().view(1, 1, 2, 2, 2)
     assert feat.grad.allclose(grad_feat)
+
+
+def _random_bev_pool_inputs(num_points=64, num_voxels=8, D=4, H=3, W=3, C=5):
+    depth = torch.randn(1, 2, D, H, W, device='cuda')
+    feat = torch.randn(1, 2, H, W, C, device='cuda')
+    ranks_depth = torch.randint(
+        0, depth.numel(), (num_points, ), device='cuda').int()
+    ranks_feat = torch.div(
+        ranks_depth, D * H * W, rounding_mode='floor') * (H * W) + \
+        ranks_depth % (H * W)
+    ranks_bev, order = torch.randint(
+        0, num_voxels, (num_points, ), device='cuda').sort()
+    ranks_depth, ranks_feat = ranks_depth[order], ranks_feat[order].int()
+    interval_lengths = torch.unique_consecutive(
+        ranks_bev, return_counts=True)[1]
+    interval_starts = interval_lengths.cumsum(0) - interval_lengths
+    return depth, feat, ranks_depth, ranks_feat, ranks_bev.int(), \
+        (1, 1, 1, num_voxels, C), interval_starts.int(), \
+        interval_lengths.int()
+
+
+def test_bev_pool_v2_softmax():
+    depth, feat, *inputs = _random_bev_pool_inputs()
+    depth_ref = depth.clone().requires_grad_()
+    feat_ref = feat.clone().requires_grad_()
+    depth.requires_grad_()
+    feat.requires_grad_()
+    bev_feat = bev_pool_v2(depth, feat, *inputs, fused_softmax=True)
+    bev_feat_ref = bev_pool_v2(depth_ref.softmax(dim=2), feat_ref, *inputs)
+    assert bev_feat.allclose(bev_feat_ref, atol=1e-5)
+    out_grad = torch.randn_like(bev_feat)
+    bev_feat.backward(out_grad)
+    bev_feat_ref.backward(out_grad)
+    assert depth.grad.allclose(depth_ref.grad, atol=1e-5)
+    assert feat.grad.allclose(feat_ref.grad, atol=1e-5)
+
+
+def test_quantized_bev_pool_v2():
+    depth, feat, *inputs = _random_bev_pool_inputs()
+    depth = depth.softmax(dim=2)
+    bev_feat = bev_pool_v2(depth, feat, *inputs, quantize=True)
+    bev_feat_ref = bev_pool_v2(depth, feat, *inputs)
+    # each product is off by at most half a step of both quantizations
+    max_length = inputs[-1].max().item()
+    atol = max_length * feat.abs().max().item() * (0.5 / 255 + 0.5 / 127 +
+                                                   0.25 / (255 * 127))
+    assert bev_feat.allclose(bev_feat_ref, atol=atol)
@@ -8,6 +8,16 @@ void bev_pool_v2(int c, int n_intervals, const float* depth, const float* feat,
     const int* ranks_depth, const int* ranks_feat, const int* ranks_bev,
     const int* interval_starts, const int* interval_lengths, float* out);
 
+void bev_pool_v2_softmax(int c, int n_intervals, const float* depth,
+    const float* depth_lse, const float* feat, const int* ranks_depth,
+    const int* ranks_feat, const int* ranks_bev, const int* interval_starts,
+    const int* interval_lengths, float* out);
+
+void bev_pool_v2_int8(int c, int n_intervals, const uint8_t* depth,
+    const int8_t* feat, const float* scale, const int* ranks_depth,
+    const int* ranks_feat, const int* ranks_bev, const int* interval_starts,
+    const int* interval_lengths, float* out);
+
 void bev_pool_v2_grad(int c, int n_intervals, const float* out_grad,
   const float* depth, const float* feat, const int* ranks_depth, const int* ranks_feat,
   const int* ranks_bev, const int* interval_starts, const int* interval_lengths,
@@ -57,6 +67,98 @@ void bev_pool_v2_forward(
 }
 
 
+/*
+  Function: pillar pooling with the depth softmax fused (forward, cuda)
+  Args:
+    depth            : input depth logits, FloatTensor[n, d, h, w]
+    depth_lse        : logsumexp of the depth logits along d, FloatTensor[n, h, w]
+    feat             : input features, FloatTensor[n, h, w, c]
+    out              : output features, FloatTensor[b, c, h_out, w_out]
+    ranks_depth      : depth index of points, IntTensor[n_points]
+    ranks_feat       : feat index of points, IntTensor[n_points]
+    ranks_bev        : output index of points, IntTensor[n_points]
+    interval_lengths : starting position for pooled point, IntTensor[n_intervals]
+    interval_starts  : how many points in each pooled point, IntTensor[n_intervals]
+  Return:
+*/
+void bev_pool_v2_softmax_forward(
+  const at::Tensor _depth,
+  const at::Tensor _depth_lse,
+  const at::Tensor _feat,
+  at::Tensor _out,
+  const at::Tensor _ranks_depth,
+  const at::Tensor _ranks_feat,
+  const at::Tensor _ranks_bev,
+  const at::Tensor _interval_lengths,
+  const at::Tensor _interval_starts
+) {
+  int c = _feat.size(4);
+  int n_intervals = _interval_lengths.size(0);
+  const at::cuda::OptionalCUDAGuard device_guard(device_of(_depth));
+  const float* depth = _depth.data_ptr<float>();
+  const float* depth_lse = _depth_lse.data_ptr<float>();
+  const float* feat = _feat.data_ptr<float>();
+  const int* ranks_depth = _ranks_depth.data_ptr<int>();
+  const int* ranks_feat = _ranks_feat.data_ptr<int>();
+  const int* ranks_bev = _ranks_bev.data_ptr<int>();
+
+  const int* interval_lengths = _interval_lengths.data_ptr<int>();
+  const int* interval_starts = _interval_starts.data_ptr<int>();
+
+  float* out = _out.data_ptr<float>();
+  bev_pool_v2_softmax(
+    c, n_intervals, depth, depth_lse, feat, ranks_depth, ranks_feat,
+    ranks_bev, interval_starts, interval_lengths, out
+  );
+}
+
+
+/*
+  Function: pillar pooling on quantized inputs (forward, cuda)
+  Args:
+    depth            : input depth quantized with scale 1/255, ByteTensor[n, d, h, w]
+    feat             : input features quantized per channel, CharTensor[n, h, w, c]
+    scale            : dequantization scale of each channel, FloatTensor[c]
+    out              : output features, FloatTensor[b, c, h_out, w_out]
+    ranks_depth      : depth index of points, IntTensor[n_points]
+    ranks_feat       : feat index of points, IntTensor[n_points]
+    ranks_bev        : output index of points, IntTensor[n_points]
+    interval_lengths : starting position for pooled point, IntTensor[n_intervals]
+    interval_starts  : how many points in each pooled point, IntTensor[n_intervals]
+  Return:
+*/
+void bev_pool_v2_int8_forward(
+  const at::Tensor _depth,
+  const at::Tensor _feat,
+  const at::Tensor _scale,
+  at::Tensor _out,
+  const at::Tensor _ranks_depth,
+  const at::Tensor _ranks_feat,
+  const at::Tensor _ranks_bev,
+  const at::Tensor _interval_lengths,
+  const at::Tensor _interval_starts
+) {
+  int c = _feat.size(4);
+  int n_intervals = _interval_lengths.size(0);
+  const at::cuda::OptionalCUDAGuard device_guard(device_of(_depth));
+  const uint8_t* depth = _depth.data_ptr<uint8_t>();
+  const int8_t* feat = _feat.data_ptr<int8_t>();
+  const float* scale = _scale.data_ptr<float>();
+  const int* ranks_depth = _ranks_depth.data_ptr<int>();
+  const int* ranks_feat = _ranks_feat.data_ptr<int>();
+  const int* ranks_bev = _ranks_bev.data_ptr<int>();
+
+  const int* interval_lengths = _interval_lengths.data_ptr<int>();
+  const int* interval_starts = _interval_starts.data_ptr<int>();
+
+  float* out = _out.data_ptr<float>();
+  bev_pool_v2_int8(
+    c, n_intervals, depth, feat, scale, ranks_depth, ranks_feat,
+    ranks_bev, interval_starts, interval_lengths, out
+  );
+}
+
+
 /*
   Function: pillar pooling (backward, cuda)
   Args:
@@ -106,6 +208,10 @@ void bev_pool_v2_backward(
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   m.def("bev_pool_v2_forward", &bev_pool_v2_forward,
         "bev_pool_v2_forward");
+  m.def("bev_pool_v2_softmax_forward", &bev_pool_v2_softmax_forward,
+        "bev_pool_v2_softmax_forward");
+  m.def("bev_pool_v2_int8_forward", &bev_pool_v2_int8_forward,
+        "bev_pool_v2_int8_forward");
   m.def("bev_pool_v2_backward", &bev_pool_v2_backward,
         "bev_pool_v2_backward");
 }
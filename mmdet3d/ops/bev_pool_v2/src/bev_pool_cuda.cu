@@ -1,8 +1,10 @@
 // Copyright (c) Phigent Robotics. All rights reserved.
 // Reference https://arxiv.org/abs/2211.17111
 
+#include <stdint.h>
 #include <stdio.h>
 #include <stdlib.h>
+#include <ATen/cuda/CUDAContext.h>
 
 /*
   Function: pillar pooling
@@ -48,6 +50,98 @@ __global__ void bev_pool_v2_kernel(int c, int n_intervals,
 }
 
 
+/*
+  Function: pillar pooling with the depth softmax fused
+  Args:
+    c                : number of channels
+    n_intervals      : number of unique points
+    depth            : input depth logits, FloatTensor[b,n,d,h,w]
+    depth_lse        : logsumexp of the depth logits along d, FloatTensor[b,n,h,w]
+    feat             : input feat, FloatTensor[b,n,h,w,c]
+    ranks_depth      : input index of depth, IntTensor[n]
+    ranks_feat       : input index of feat, IntTensor[n]
+    ranks_bev        : output index, IntTensor[n]
+    interval_lengths : starting position for pooled point, IntTensor[n_intervals]
+    interval_starts  : how many points in each pooled point, IntTensor[n_intervals]
+    out              : output features, FloatTensor[b, d, h, w, c]
+*/
+__global__ void bev_pool_v2_softmax_kernel(int c, int n_intervals,
+                                  const float *__restrict__ depth,
+                                  const float *__restrict__ depth_lse,
+                                  const float *__restrict__ feat,
+                                  const int *__restrict__ ranks_depth,
+                                  const int *__restrict__ ranks_feat,
+                                  const int *__restrict__ ranks_bev,
+                                  const int *__restrict__ interval_starts,
+                                  const int *__restrict__ interval_lengths,
+                                  float* __restrict__ out) {
+  int idx = blockIdx.x * blockDim.x + threadIdx.x;
+  int index = idx / c;
+  int cur_c = idx % c;
+  if (index >= n_intervals) return;
+  int interval_start = interval_starts[index];
+  int interval_length = interval_lengths[index];
+  float psum = 0;
+  int cur_rank_feat;
+  float cur_prob;
+  for(int i = 0; i < interval_length; i++){
+    // ranks_feat indexes the pixel, which is also the depth column
+    cur_rank_feat = ranks_feat[interval_start+i];
+    cur_prob = __expf(depth[ranks_depth[interval_start+i]] -
+                      depth_lse[cur_rank_feat]);
+    psum += feat[cur_rank_feat * c + cur_c] * cur_prob;
+  }
+
+  const int* cur_rank = ranks_bev + interval_start;
+  float* cur_out = out + *cur_rank * c + cur_c;
+  *cur_out = psum;
+}
+
+
+/*
+  Function: pillar pooling on quantized inputs, inference only
+  Args:
+    c                : number of channels
+    n_intervals      : number of unique points
+    depth            : input depth quantized with scale 1/255, ByteTensor[b,n,d,h,w]
+    feat             : input feat quantized per channel, CharTensor[b,n,h,w,c]
+    scale            : dequantization scale of each channel, FloatTensor[c]
+    ranks_depth      : input index of depth, IntTensor[n]
+    ranks_feat       : input index of feat, IntTensor[n]
+    ranks_bev        : output index, IntTensor[n]
+    interval_lengths : starting position for pooled point, IntTensor[n_intervals]
+    interval_starts  : how many points in each pooled point, IntTensor[n_intervals]
+    out              : output features, FloatTensor[b, d, h, w, c]
+*/
+__global__ void bev_pool_v2_int8_kernel(int c, int n_intervals,
+                                  const uint8_t *__restrict__ depth,
+                                  const int8_t *__restrict__ feat,
+                                  const float *__restrict__ scale,
+                                  const int *__restrict__ ranks_depth,
+                                  const int *__restrict__ ranks_feat,
+                                  const int *__restrict__ ranks_bev,
+                                  const int *__restrict__ interval_starts,
+                                  const int *__restrict__ interval_lengths,
+                                  float* __restrict__ out) {
+  int idx = blockIdx.x * blockDim.x + threadIdx.x;
+  int index = idx / c;
+  int cur_c = idx % c;
+  if (index >= n_intervals) return;
+  int interval_start = interval_starts[index];
+  int interval_length = interval_lengths[index];
+  // accumulate in int32 and dequantize once
+  int psum = 0;
+  for(int i = 0; i < interval_length; i++){
+    psum += (int)feat[ranks_feat[interval_start+i] * c + cur_c] *
+            (int)depth[ranks_depth[interval_start+i]];
+  }
+
+  const int* cur_rank = ranks_bev + interval_start;
+  float* cur_out = out + *cur_rank * c + cur_c;
+  *cur_out = psum * scale[cur_c];
+}
+
+
 /*
   Function: pillar pooling backward
   Args:
@@ -124,16 +218,40 @@ __global__ void bev_pool_grad_kernel(int c, int n_intervals,
 
 void bev_pool_v2(int c, int n_intervals, const float* depth, const float* feat, const int* ranks_depth,
   const int* ranks_feat, const int* ranks_bev, const int* interval_starts, const int* interval_lengths, float* out) {
-  bev_pool_v2_kernel<<<(int)ceil(((double)n_intervals * c / 256)), 256>>>(
+  bev_pool_v2_kernel<<<(int)ceil(((double)n_intervals * c / 256)), 256, 0,
+      at::cuda::getCurrentCUDAStream()>>>(
     c, n_intervals, depth, feat, ranks_depth, ranks_feat,
     ranks_bev, interval_starts, interval_lengths, out
   );
 }
 
+void bev_pool_v2_softmax(int c, int n_intervals, const float* depth,
+  const float* depth_lse, const float* feat, const int* ranks_depth,
+  const int* ranks_feat, const int* ranks_bev, const int* interval_starts,
+  const int* interval_lengths, float* out) {
+  bev_pool_v2_softmax_kernel<<<(int)ceil(((double)n_intervals * c / 256)), 256, 0,
+      at::cuda::getCurrentCUDAStream()>>>(
+    c, n_intervals, depth, depth_lse, feat, ranks_depth, ranks_feat,
+    ranks_bev, interval_starts, interval_lengths, out
+  );
+}
+
+void bev_pool_v2_int8(int c, int n_intervals, const uint8_t* depth,
+  const int8_t* feat, const float* scale, const int* ranks_depth,
+  const int* ranks_feat, const int* ranks_bev, const int* interval_starts,
+  const int* interval_lengths, float* out) {
+  bev_pool_v2_int8_kernel<<<(int)ceil(((double)n_intervals * c / 256)), 256, 0,
+      at::cuda::getCurrentCUDAStream()>>>(
+    c, n_intervals, depth, feat, scale, ranks_depth, ranks_feat,
+    ranks_bev, interval_starts, interval_lengths, out
+  );
+}
+
 void bev_pool_v2_grad(int c, int n_intervals, const float* out_grad,
   const float* depth, const float* feat, const int* ranks_depth, const int* ranks_feat,
   const int* ranks_bev, const int* interval_starts, const int* interval_lengths, float* depth_grad, float* feat_grad) {
-  bev_pool_grad_kernel<<<(int)ceil(((double)n_intervals / 256)), 256>>>(
+  bev_pool_grad_kernel<<<(int)ceil(((double)n_intervals / 256)), 256, 0,
+      at::cuda::getCurrentCUDAStream()>>>(
      c, n_intervals, out_grad, depth, feat, ranks_depth, ranks_feat,
      ranks_bev, interval_starts, interval_lengths, depth_grad, feat_grad
   );